@@ -0,0 +1,308 @@
+"""
+Headless benchmarks of the CPU-side IC-Light pipeline
+
+    python benchmarks/bench_cpu.py --output bench.json
+    python benchmarks/bench_cpu.py --baseline bench.json --tolerance 0.25
+
+Requires numpy, opencv, pillow and torch; the rembg benchmark additionally
+requires rembg, onnxruntime and onnx (to build a tiny stand-in model)
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import webui_stubs  # noqa: E402
+
+webui_stubs.install(
+    ic_rembg_cache=0,
+    ic_rembg_cache_disk=False,
+    ic_resize_backend="PIL",
+)
+
+import numpy as np  # noqa: E402
+import torch  # noqa: E402
+
+from lib_iclight.detail_utils import DetailRestorer, restore_detail  # noqa: E402
+from lib_iclight.utils import (  # noqa: E402
+    forge_numpy2pytorch,
+    make_masked_area_grey,
+    numpy2pytorch,
+    resize_and_center_crop,
+)
+
+SIZES = (512, 1024, 2048, 4096)
+BENCHMARKS: dict[str, Callable[[int], Callable[[], object]]] = {}
+
+
+def benchmark(name: str):
+    """Register a setup function, which returns the callable to time"""
+
+    def decorator(setup: Callable[[int], Callable[[], object]]):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+def subject(size: int, alpha: bool = False) -> np.ndarray:
+    """A smooth synthetic subject: a bright disc on a gradient"""
+    xs = np.linspace(0.0, 1.0, size, dtype=np.float32)
+    d = np.hypot(xs[None, :] - 0.5, xs[:, None] - 0.5)
+    disc = (d < 0.3).astype(np.float32)
+
+    rgb = np.stack(
+        [xs[None, :] * 255 * (1 - disc) + 200 * disc] * 2
+        + [xs[:, None] * 255 * (1 - disc) + 60 * disc],
+        axis=-1,
+    )
+    rgb = np.broadcast_to(rgb, (size, size, 3)).astype(np.uint8)
+
+    if not alpha:
+        return rgb
+
+    return np.concatenate([rgb, (disc[..., None] * 255).astype(np.uint8)], axis=-1)
+
+
+def _resize(backend: str):
+    def setup(size: int):
+        from modules.shared import opts
+
+        image = subject(size)
+
+        def run():
+            opts.ic_resize_backend = backend
+            return resize_and_center_crop(image, size * 3 // 4, size)
+
+        return run
+
+    return setup
+
+
+for _backend in ("PIL", "OpenCV", "torch"):
+    benchmark(f"resize_and_center_crop[{_backend}]")(_resize(_backend))
+
+
+@benchmark("make_masked_area_grey")
+def _grey(size: int):
+    image = subject(size, alpha=True)
+    rgb, alpha = image[..., :3], image[..., 3:].astype(np.float32) / 255.0
+    return lambda: make_masked_area_grey(rgb, alpha)
+
+
+@benchmark("refine_alpha")
+def _refine_alpha(size: int):
+    from lib_iclight.matting import refine_alpha
+
+    image = subject(size, alpha=True)
+    return lambda: refine_alpha(image[..., :3], image[..., 3], 225, 16, 16)
+
+
+@benchmark("restore_detail")
+def _restore(size: int):
+    output, original = subject(size), subject(size // 2)
+    return lambda: restore_detail(output, original, 3)
+
+
+@benchmark("DetailRestorer.restore")
+def _restorer(size: int):
+    """The per-image cost once the original is prepared"""
+    output, restorer = subject(size), DetailRestorer(subject(size // 2), 3)
+    restorer.restore(output)
+    return lambda: restorer.restore(output)
+
+
+@benchmark("numpy2pytorch")
+def _numpy2pytorch(size: int):
+    images = np.stack([subject(size)] * 2)
+    return lambda: numpy2pytorch(images)
+
+
+@benchmark("forge_numpy2pytorch")
+def _forge_numpy2pytorch(size: int):
+    images = np.stack([subject(size)] * 2)
+    return lambda: forge_numpy2pytorch(images)
+
+
+def _iclight_args(model_type: str, size: int):
+    from modules.processing import StableDiffusionProcessingTxt2Img
+
+    from lib_iclight.model_loader import ICModels, ModelInfo
+    from lib_iclight.parameters import ICLightArgs
+
+    ICModels.fc, ICModels.fbc = "fc", "fbc"
+    ICModels.models = {kind: ModelInfo("", kind, False) for kind in ("fc", "fbc")}
+    p = StableDiffusionProcessingTxt2Img(width=size, height=size * 3 // 4)
+
+    args = ICLightArgs(
+        p,
+        model_type=model_type,
+        input_fg=subject(size),
+        uploaded_bg=subject(size),
+        remove_bg=False,
+        rembg_model="",
+        foreground_threshold=225,
+        background_threshold=16,
+        erode_size=16,
+        detail_transfer=False,
+        detail_transfer_raw=False,
+        detail_transfer_blur_radius=3,
+        reinforce_fg=False,
+    )
+    # keep the decoded backgrounds across the iterations
+    args._memoized = True
+
+    def concat():
+        # measure the resize and concat, not the memos of the previous iteration
+        args._resized.clear()
+        args._concat.clear()
+        ICLightArgs._memo = None
+        return args.get_concat_cond(p)
+
+    return concat
+
+
+@benchmark("get_concat_cond[fc]")
+def _concat_fc(size: int):
+    return _iclight_args("fc", size)
+
+
+@benchmark("get_concat_cond[fbc]")
+def _concat_fbc(size: int):
+    return _iclight_args("fbc", size)
+
+
+def tiny_onnx(path: str):
+    """A stand-in for the u2net models; same input / output layout, trivial compute"""
+    from onnx import TensorProto, helper, save
+
+    graph = helper.make_graph(
+        [
+            helper.make_node("ReduceMean", ["input", "axes"], ["mean"], keepdims=1),
+            helper.make_node("Sigmoid", ["mean"], ["output"]),
+        ],
+        "tiny-u2net",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, [1, 3, 320, 320])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, [1, 1, 320, 320])],
+        initializer=[helper.make_tensor("axes", TensorProto.INT64, [1], [1])],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 18)])
+    model.ir_version = 8
+    save(model, path)
+
+
+@benchmark("run_rmbg")
+def _rembg(size: int):
+    import rembg
+
+    from lib_iclight.rembg_utils import SessionPool, run_rmbg
+
+    model = "u2net_custom"
+    path = os.path.join(webui_stubs.MODELS_PATH, "tiny-u2net.onnx")
+    if not os.path.isfile(path):
+        tiny_onnx(path)
+
+    SessionPool.add(model, rembg.new_session(model, model_path=path))
+    image = subject(size)
+    return lambda: run_rmbg(image, model, 225, 16, 16)
+
+
+def measure(fn: Callable[[], object], min_time: float, max_repeat: int) -> list[float]:
+    fn()  # warm up
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < max_repeat:
+        t = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - t) * 1000.0)
+        if time.perf_counter() - start > min_time:
+            break
+    return timings
+
+
+def compare(results: list[dict], baseline_path: str, tolerance: float) -> list[str]:
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = {
+            (r["name"], r["size"]): r["median_ms"] for r in json.load(file)["results"]
+        }
+
+    regressions = []
+    for r in results:
+        if (before := baseline.get((r["name"], r["size"]))) is None:
+            continue
+        if r["median_ms"] > before * (1.0 + tolerance):
+            regressions.append(
+                f"{r['name']} @ {r['size']}: {before:.2f} -> {r['median_ms']:.2f} ms"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--filter", type=str, default=None, help="regex of names")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds")
+    parser.add_argument("--max-repeat", type=int, default=20)
+    parser.add_argument("--output", type=str, default=None, help="JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = []
+    for name, setup in BENCHMARKS.items():
+        if args.filter and not re.search(args.filter, name):
+            continue
+
+        for size in args.sizes:
+            try:
+                fn = setup(size)
+            except ImportError as e:
+                print(f"skipped {name}: {e}", file=sys.stderr)
+                break
+
+            timings = measure(fn, args.min_time, args.max_repeat)
+            result = {
+                "name": name,
+                "size": size,
+                "repeat": len(timings),
+                "mean_ms": round(statistics.fmean(timings), 3),
+                "median_ms": round(statistics.median(timings), 3),
+                "min_ms": round(min(timings), 3),
+            }
+            results.append(result)
+            print(json.dumps(result), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "torch": torch.__version__,
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        if regressions := compare(results, args.baseline, args.tolerance):
+            print("Regressions:\n" + "\n".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
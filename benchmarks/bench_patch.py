@@ -0,0 +1,123 @@
+"""
+Peak VRAM and time of merging the IC-Light weights into a UNet-sized model,
+with the weights on the device versus streamed from pinned host memory
+
+    python benchmarks/bench_patch.py --window 256
+    python benchmarks/bench_patch.py --model models/ic-light/iclight_sd15_fc.safetensors
+
+The merge is a stand-in for the backend's, adding each difference to its weight
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import webui_stubs  # noqa: E402
+
+webui_stubs.install()
+
+import torch  # noqa: E402
+
+from modules.shared import opts  # noqa: E402
+
+
+class ModelPatcher:
+    def calculate_weight(self, patches: list, weight: torch.Tensor, key: str):
+        for strength, v, *_ in patches:
+            diff = v[0].to(weight.device, weight.dtype)
+            weight = weight + strength * diff.reshape(weight.shape)
+        return weight
+
+    def patch_model(self, patches: dict[str, tuple], weights: dict[str, torch.Tensor]):
+        for key, v in patches.items():
+            weights[key] = self.calculate_weight([(1.0, v, 1.0)], weights[key], key)
+
+
+def install_backend():
+    """The merge functions PatchStream wraps, as in ldm_patched"""
+    for name in ("ldm_patched", "ldm_patched.modules"):
+        sys.modules.setdefault(name, types.ModuleType(name))
+    module = types.ModuleType("ldm_patched.modules.model_patcher")
+    module.ModelPatcher = ModelPatcher
+    sys.modules[module.__name__] = module
+
+
+def synthetic(count: int, size: int, dtype: torch.dtype) -> dict[str, torch.Tensor]:
+    return {f"layer_{i}": torch.randn(size, size, dtype=dtype) for i in range(count)}
+
+
+def measure(name: str, patches: dict, weights: dict, device: torch.device) -> dict:
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    t = time.perf_counter()
+
+    ModelPatcher().patch_model(patches, weights)
+
+    torch.cuda.synchronize(device)
+    return {
+        "name": name,
+        "seconds": round(time.perf_counter() - t, 3),
+        "peak_mb": round((torch.cuda.max_memory_allocated(device) - base) / 1024**2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", type=str, default=None, help="IC-Light model")
+    parser.add_argument("--layers", type=int, default=400, help="if no --model")
+    parser.add_argument("--size", type=int, default=1024, help="if no --model")
+    parser.add_argument("--dtype", type=str, default="float16")
+    parser.add_argument("--window", type=int, default=256, help="MB")
+    args = parser.parse_args()
+
+    if not torch.cuda.is_available():
+        sys.exit("CUDA is required")
+
+    install_backend()
+    opts.ic_stream_patch = args.window
+
+    from lib_iclight import compressed, streaming
+    from lib_iclight.streaming import PatchStream
+
+    device, dtype = torch.device("cuda"), getattr(torch, args.dtype)
+    if args.model:
+        sd = {
+            k: v.to(dtype) if isinstance(v, torch.Tensor) else v.dense().to(dtype)
+            for k, v in compressed.load(args.model).items()
+        }
+    else:
+        sd = synthetic(args.layers, args.size, dtype)
+
+    def base_weights() -> dict[str, torch.Tensor]:
+        return {
+            k: torch.zeros(v.shape, dtype=dtype, device=device) for k, v in sd.items()
+        }
+
+    results = []
+
+    weights = base_weights()
+    on_device = {k: (v.to(device),) for k, v in sd.items()}
+    result = measure("device", on_device, weights, device)
+    result["peak_mb"] += round(sum(v.nbytes for v in sd.values()) / 1024**2)
+    results.append(result)
+    del weights, on_device
+
+    weights = base_weights()
+    pinned = {k: (streaming.pin(v),) for k, v in sd.items()}
+    assert PatchStream.install()
+    stream = PatchStream(pinned.values(), device)  # noqa: F841
+    results.append(measure(f"stream[{args.window}MB]", pinned, weights, device))
+
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
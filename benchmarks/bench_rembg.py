@@ -0,0 +1,122 @@
+"""
+Latency of each Background Removal model on each onnxruntime Execution Provider
+
+    python benchmarks/bench_rembg.py --u2net-home <webui>/models/u2net
+    python benchmarks/bench_rembg.py --all --providers CUDA CPU --output rembg.json
+
+Run it with the Python environment of the webui, on each node,
+then list the fastest providers in the Settings
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import webui_stubs  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--u2net-home", type=str, default=None, help="model folder")
+    parser.add_argument("--all", action="store_true", help="all rembg models")
+    parser.add_argument("--models", type=str, nargs="+", default=None)
+    parser.add_argument("--model-path", type=str, default=None, help="u2net_custom")
+    parser.add_argument("--providers", type=str, nargs="+", default=None)
+    parser.add_argument("--intra-threads", type=int, default=0)
+    parser.add_argument("--inter-threads", type=int, default=0)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--output", type=str, default=None, help="JSON file")
+    args = parser.parse_args()
+
+    if args.u2net_home:
+        os.environ["U2NET_HOME"] = args.u2net_home
+
+    webui_stubs.install(ic_all_rembg=args.all, ic_rembg_cache=0)
+
+    import onnxruntime as ort
+    from bench_cpu import subject
+    from PIL import Image
+
+    from lib_iclight.rembg_utils import get_models, new_session
+
+    models = args.models or get_models()
+    available = ort.get_available_providers()
+    # the Azure provider runs the inference remotely
+    local = [name for name in available if not name.startswith("Azure")]
+    providers = [
+        p if p.endswith("ExecutionProvider") else f"{p}ExecutionProvider"
+        for p in (args.providers or local)
+    ]
+
+    image = Image.fromarray(subject(args.size))
+    threads = (args.intra_threads, args.inter_threads)
+    kwargs = {"model_path": args.model_path} if args.model_path else {}
+
+    results = []
+    for model in models:
+        for provider in providers:
+            if provider not in available:
+                print(f"skipped {provider}: not available", file=sys.stderr)
+                continue
+
+            try:
+                t = time.perf_counter()
+                session = new_session(model, (provider,), threads, **kwargs)
+                load = time.perf_counter() - t
+                session.predict(image)  # warm up
+
+                timings = []
+                for _ in range(args.repeat):
+                    t = time.perf_counter()
+                    session.predict(image)
+                    timings.append((time.perf_counter() - t) * 1000.0)
+            except Exception as e:
+                print(f"skipped {model} on {provider}: {e}", file=sys.stderr)
+                continue
+
+            result = {
+                "model": model,
+                "provider": provider,
+                "used": session.inner_session.get_providers()[0],
+                "load_s": round(load, 3),
+                "median_ms": round(statistics.median(timings), 3),
+                "min_ms": round(min(timings), 3),
+            }
+            results.append(result)
+            print(json.dumps(result), file=sys.stderr)
+
+    fastest = {}
+    for r in results:
+        if r["model"] not in fastest or r["median_ms"] < fastest[r["model"]][1]:
+            fastest[r["model"]] = (r["provider"], r["median_ms"])
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "onnxruntime": ort.__version__,
+            "available": available,
+            "cpu_count": os.cpu_count(),
+            "size": args.size,
+            "threads": threads,
+        },
+        "results": results,
+        "fastest": {model: provider for model, (provider, _) in fastest.items()},
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
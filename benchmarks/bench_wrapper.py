@@ -0,0 +1,126 @@
+"""
+Allocations and time per step of the c_concat injection in the UNet wrapper
+
+    python benchmarks/bench_wrapper.py
+    python benchmarks/bench_wrapper.py --device cuda --batch 4 --size 1024
+
+"legacy" is the previous implementation, which repeats and concatenates
+the conditioning at every step; "cached" is ConcatCond
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import webui_stubs  # noqa: E402
+
+webui_stubs.install()
+
+import torch  # noqa: E402
+from torch.profiler import ProfilerActivity, profile  # noqa: E402
+
+from lib_iclight.concat_cond import ConcatCond  # noqa: E402
+
+
+def legacy_repeat(concat_conds: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+    return torch.cat(
+        ([concat_conds.to(x.device)] * (x.shape[0] // concat_conds.shape[0])),
+        dim=0,
+    )
+
+
+def legacy_concat(concat_conds: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+    return torch.cat([x, legacy_repeat(concat_conds, x)], dim=1)
+
+
+def allocations(step: Callable[[], object], steps: int, device: torch.device):
+    """(count, bytes) of the allocations over the steps"""
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        before = torch.cuda.memory_stats()
+        for _ in range(steps):
+            step()
+        torch.cuda.synchronize()
+        after = torch.cuda.memory_stats()
+        return (
+            after["allocation.all.allocated"] - before["allocation.all.allocated"],
+            after["allocated_bytes.all.allocated"]
+            - before["allocated_bytes.all.allocated"],
+        )
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        for _ in range(steps):
+            step()
+
+    sizes = [
+        e.cpu_memory_usage
+        for e in prof.events()
+        if e.name != "[memory]" and e.cpu_memory_usage > 0
+    ]
+    return len(sizes), sum(sizes)
+
+
+def timing(step: Callable[[], object], steps: int, device: torch.device) -> float:
+    """Milliseconds per step"""
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t) * 1000.0 / steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32")
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--size", type=int, default=512, help="pixels")
+    parser.add_argument("--channels", type=int, default=4, help="4 = fc; 8 = fbc")
+    parser.add_argument("--steps", type=int, default=30)
+    args = parser.parse_args()
+
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    h = w = args.size // 8
+
+    concat_conds = torch.randn(args.batch, args.channels, h, w, dtype=dtype)
+    concat_conds = concat_conds.to(device)
+    x = torch.randn(args.batch * 2, 4, h, w, dtype=dtype, device=device)  # CFG
+
+    cond = ConcatCond()
+    cond.samples = concat_conds
+
+    cases = {
+        "forge[legacy]": lambda: legacy_repeat(concat_conds, x),
+        "forge[cached]": lambda: cond.repeated(x),
+        "a1111[legacy]": lambda: legacy_concat(concat_conds, x),
+        "a1111[cached]": lambda: cond.concat(x),
+    }
+
+    assert torch.equal(cases["forge[legacy]"](), cases["forge[cached]"]())
+    assert torch.equal(cases["a1111[legacy]"](), cases["a1111[cached]"]())
+
+    results = []
+    for name, step in cases.items():
+        step()  # warm up; builds the cached tensors
+        count, size = allocations(step, args.steps, device)
+        result = {
+            "name": name,
+            "allocations_per_step": count / args.steps,
+            "kb_per_step": round(size / 1024 / args.steps, 1),
+            "ms_per_step": round(timing(step, args.steps, device), 4),
+        }
+        results.append(result)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
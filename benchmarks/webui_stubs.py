@@ -0,0 +1,118 @@
+"""
+Minimal stand-ins for the webui `modules.*` imported by lib_iclight,
+so that the CPU-side pipeline can be imported and timed outside of the webui
+
+Import this module before importing anything from lib_iclight
+"""
+
+import base64
+import io
+import os
+import sys
+import tempfile
+import types
+from types import SimpleNamespace
+
+import torch
+from PIL import Image
+
+MODELS_PATH = os.path.join(tempfile.gettempdir(), "ic-light-bench", "models")
+
+
+def _module(name: str, **attrs) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+
+    return module
+
+
+def resize_image(resize_mode: int, im: Image.Image, width: int, height: int):
+    """Crop and Resize (resize_mode 1) of modules.images.resize_image"""
+    assert resize_mode == 1
+
+    ratio = width / height
+    src_ratio = im.width / im.height
+
+    src_w = width if ratio > src_ratio else im.width * height // im.height
+    src_h = height if ratio <= src_ratio else im.height * width // im.width
+
+    resized = im.resize((src_w, src_h), resample=Image.Resampling.LANCZOS)
+    res = Image.new("RGB", (width, height))
+    res.paste(resized, box=(width // 2 - src_w // 2, height // 2 - src_h // 2))
+    return res
+
+
+def decode_base64_to_image(encoding: str) -> Image.Image:
+    if encoding.startswith("data:image/"):
+        encoding = encoding.split(";")[1].split(",")[1]
+    return Image.open(io.BytesIO(base64.b64decode(encoding)))
+
+
+class OptionInfo:
+    def __init__(self, default=None, label="", *args, **kwargs):
+        self.default = default
+
+    def info(self, *args, **kwargs):
+        return self
+
+    def needs_reload_ui(self):
+        return self
+
+    def needs_restart(self):
+        return self
+
+
+class StableDiffusionProcessing:
+    def __init__(self, width: int = 512, height: int = 512, batch_size: int = 1):
+        self.width = width
+        self.height = height
+        self.batch_size = batch_size
+
+
+class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
+    is_hr_pass: bool = False
+
+
+class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
+    init_images: list = []
+
+
+def install(**options):
+    """Register the stub modules; `options` become the values of `shared.opts`"""
+    if "modules" in sys.modules:
+        return
+
+    os.makedirs(MODELS_PATH, exist_ok=True)
+
+    _module("modules")
+    _module("modules.paths", models_path=MODELS_PATH)
+    _module(
+        "modules.shared",
+        opts=SimpleNamespace(**options),
+        OptionInfo=OptionInfo,
+    )
+    _module(
+        "modules.devices",
+        device=torch.device("cpu"),
+        dtype=torch.float32,
+        cpu=torch.device("cpu"),
+    )
+    _module(
+        "modules.images",
+        LANCZOS=Image.Resampling.LANCZOS,
+        resize_image=resize_image,
+    )
+    _module("modules.sd_vae", loaded_vae_file=None)
+    _module("modules.api")
+    _module("modules.api.api", decode_base64_to_image=decode_base64_to_image)
+    _module(
+        "modules.processing",
+        StableDiffusionProcessing=StableDiffusionProcessing,
+        StableDiffusionProcessingTxt2Img=StableDiffusionProcessingTxt2Img,
+        StableDiffusionProcessingImg2Img=StableDiffusionProcessingImg2Img,
+    )
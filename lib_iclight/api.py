@@ -0,0 +1,244 @@
+import json
+import os
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from modules.api.models import (
+    StableDiffusionImg2ImgProcessingAPI,
+    StableDiffusionTxt2ImgProcessingAPI,
+)
+
+from .backgrounds import BackgroundFC, Light, light_map
+from .cache import LRUCache
+from .image_source import LazyImage
+from .logging import logger
+from .matting import MATTING
+from .model_loader import ICModels
+from .profiler import Profiler
+from .rembg_utils import RembgPrefetch
+
+if TYPE_CHECKING:
+    from modules.api.api import Api
+
+SCRIPT_NAME = "ic light"
+
+
+class RelightJob(BaseModel):
+    foreground: str | dict[str, Any] = Field(
+        title="Foreground",
+        description="base64 image, or any other source accepted by the script; "
+        "only base64 when Light is set",
+    )
+    background: Optional[str | dict[str, Any]] = Field(
+        default=None, title="Background", description="same as Foreground; for fbc"
+    )
+    light: Optional[float | str] = Field(
+        default=None,
+        title="Light",
+        description='Light Direction; either a Background Source (eg. "Left Light") '
+        "or an angle in degrees (0 = from the right, 90 = from the top). "
+        "Runs img2img with the Foreground as the input image when set",
+    )
+    seed: int = Field(default=-1, title="Seed")
+    prompt: Optional[str] = Field(default=None, title="Prompt")
+    negative_prompt: Optional[str] = Field(default=None, title="Negative Prompt")
+
+
+class RelightRequest(BaseModel):
+    jobs: list[RelightJob] = Field(title="Jobs")
+    model_type: Optional[str] = Field(default=None, title="IC-Light Model")
+    prompt: str = Field(default="", title="Prompt")
+    negative_prompt: str = Field(default="", title="Negative Prompt")
+    width: int = Field(default=512, title="Width")
+    height: int = Field(default=512, title="Height")
+    steps: int = Field(default=25, title="Steps")
+    cfg_scale: float = Field(default=2.0, title="CFG Scale")
+    denoising_strength: float = Field(default=0.95, title="Denoising Strength")
+    remove_bg: bool = Field(default=True, title="Background Removal")
+    rembg_model: str = Field(default="u2net_human_seg", title="Rembg Model")
+    foreground_threshold: int = Field(default=225, title="Foreground Threshold")
+    background_threshold: int = Field(default=16, title="Background Threshold")
+    erode_size: int = Field(default=16, title="Erode Size")
+    matting: str = Field(
+        default=MATTING[0], title="Matting", description=" / ".join(MATTING)
+    )
+    rembg_max_size: int = Field(
+        default=0,
+        title="Segmentation Resolution",
+        description="caps the longest side for Background Removal; 0 = original",
+    )
+    detail_transfer: bool = Field(default=False, title="Restore Details")
+    detail_transfer_raw: bool = Field(default=False, title="Restore from Raw Input")
+    detail_transfer_blur_radius: int = Field(default=3, title="Blur Radius")
+    output: Optional[dict[str, str]] = Field(
+        default=None,
+        title="Output",
+        description='{"shm": prefix} or {"npy": directory}; also write the outputs '
+        "as raw arrays for callers on the same machine (requires Local Inputs)",
+    )
+    override: dict[str, Any] = Field(
+        default={},
+        title="Override",
+        description="Additional fields for the txt2img / img2img request",
+    )
+
+
+def _light_map(light: float | str, width: int, height: int):
+    if isinstance(light, str):
+        return BackgroundFC(light).get_bg(width, height)
+    return light_map((Light(angle=float(light)),), width, height)
+
+
+def _job_output(output: dict[str, str] | None, index: int) -> dict | None:
+    """Give each job its own shared memory prefix / subdirectory"""
+    if output is None:
+        return None
+    if "shm" in output:
+        return {"shm": f"{output['shm']}_{index}"}
+    return {"npy": os.path.join(output["npy"], str(index))}
+
+
+def _script_args(
+    req: RelightRequest, job: RelightJob, input_fg, output: dict | None
+) -> list:
+    """Positional args of ICLightScript, following the order of its components"""
+    return [
+        True,
+        req.model_type or ICModels.fc,
+        input_fg,
+        job.background,
+        req.remove_bg,
+        req.rembg_model,
+        req.foreground_threshold,
+        req.background_threshold,
+        req.erode_size,
+        req.detail_transfer,
+        req.detail_transfer_raw,
+        req.detail_transfer_blur_radius,
+        False,
+        output,
+        req.matting,
+        req.rembg_max_size,
+    ]
+
+
+def _run(api: "Api", req: RelightRequest, job: RelightJob, index: int) -> dict:
+    output = _job_output(req.output, index)
+    params = {
+        "prompt": req.prompt if job.prompt is None else job.prompt,
+        "negative_prompt": (
+            req.negative_prompt if job.negative_prompt is None else job.negative_prompt
+        ),
+        "seed": job.seed,
+        "width": req.width,
+        "height": req.height,
+        "steps": req.steps,
+        "cfg_scale": req.cfg_scale,
+        "send_images": output is None,
+        "save_images": False,
+        **req.override,
+    }
+
+    if job.light is None:
+        params["alwayson_scripts"] = {
+            SCRIPT_NAME: {"args": _script_args(req, job, job.foreground, output)}
+        }
+        response = api.text2imgapi(StableDiffusionTxt2ImgProcessingAPI(**params))
+
+    else:
+        # at the size actually sampled, after the override
+        lightmap = _light_map(job.light, params["width"], params["height"])
+        params["init_images"] = [job.foreground]
+        params["denoising_strength"] = req.denoising_strength
+        params["alwayson_scripts"] = {
+            SCRIPT_NAME: {"args": _script_args(req, job, lightmap, output)}
+        }
+        response = api.img2imgapi(StableDiffusionImg2ImgProcessingAPI(**params))
+
+    result = {"images": response.images, "info": response.info}
+    if output is not None:
+        outputs = json.loads(response.info).get("extra_generation_params", {})
+        result["outputs"] = outputs.get("IC-Light Outputs", [])
+    return result
+
+
+def _prefetch(req: RelightRequest, job: RelightJob):
+    """Start removing the background of the job, while the previous ones run"""
+    if not req.remove_bg or RembgPrefetch.workers() <= 0:
+        return
+
+    try:
+        RembgPrefetch.submit(
+            LazyImage.decode(job.foreground),
+            req.rembg_model,
+            req.foreground_threshold,
+            req.background_threshold,
+            req.erode_size,
+            req.matting,
+            req.rembg_max_size,
+        )
+    except Exception as e:
+        logger.debug(f"Skipped the Background Removal prefetch: {e}")
+
+
+def _find_api(app: FastAPI) -> Optional["Api"]:
+    """The webui does not expose its Api instance; retrieve it from the routes"""
+    for route in app.routes:
+        if getattr(route, "path", None) == "/sdapi/v1/txt2img":
+            return getattr(route.endpoint, "__self__", None)
+    return None
+
+
+def ic_light_api(_, app: FastAPI):
+    if (api := _find_api(app)) is None:
+        logger.debug("API is not enabled; skipping the IC-Light endpoints")
+        return
+
+    @app.post("/ic-light/v1/relight", tags=["IC-Light"])
+    def relight(req: RelightRequest):
+        """
+        Run the jobs in order, streaming each result as soon as it finishes,
+        as one JSON object per line (NDJSON)
+        """
+        if req.model_type is not None and req.model_type not in ICModels.models:
+            raise HTTPException(status_code=422, detail="Unknown IC-Light Model")
+        if req.matting not in MATTING:
+            raise HTTPException(status_code=422, detail="Unknown Matting")
+        if req.output is not None and not ({"shm", "npy"} & req.output.keys()):
+            raise HTTPException(status_code=422, detail="Unknown Output")
+        lit = [j for j in req.jobs if j.light is not None]
+        model = req.model_type or ICModels.fc
+        if lit and (model not in ICModels.models or ICModels.get_kind(model) != "fc"):
+            raise HTTPException(status_code=422, detail="Light requires an fc Model")
+        if any(isinstance(j.foreground, dict) for j in lit):
+            raise HTTPException(
+                status_code=422, detail="Light requires a base64 Foreground"
+            )
+
+        def stream() -> Iterator[str]:
+            prefetched = 0
+            # the jobs share the loaded model, even with the caches disabled
+            with LRUCache.scope():
+                for index, job in enumerate(req.jobs):
+                    ahead = min(len(req.jobs), index + 1 + RembgPrefetch.workers())
+                    for upcoming in req.jobs[prefetched:ahead]:
+                        _prefetch(req, upcoming)
+                    prefetched = max(prefetched, ahead)
+
+                    try:
+                        result = {"index": index, **_run(api, req, job, index)}
+                    except Exception as e:
+                        logger.error(f"Relight Job {index} failed: {e}")
+                        result = {"index": index, "error": str(e)}
+
+                    yield json.dumps(result) + "\n"
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    @app.get("/ic-light/v1/stats", tags=["IC-Light"])
+    def stats() -> dict:
+        """p50 / p95 of the wall time, CPU time and peak memory of each stage"""
+        return {"enabled": Profiler.enabled(), "stages": Profiler.summary()}
@@ -15,13 +15,19 @@ if TYPE_CHECKING:
 
 from functools import wraps
 
-import safetensors.torch
+import numpy as np
 import torch
 
+from modules import devices
 from modules.devices import device, dtype
 
-from ..model_loader import ICModels
+from .. import compressed, conv_split
+from ..concat_cond import ConcatCond
+from ..conv_split import ConcatFeatures
+from ..model_loader import ICModelCache, ICModels
+from ..profiler import Profiler
 from ..utils import numpy2pytorch
+from ..vae_utils import encode_concat
 
 
 def vae_encode(sd_model, image: torch.Tensor) -> torch.Tensor:
@@ -36,35 +42,60 @@ def vae_encode(sd_model, image: torch.Tensor) -> torch.Tensor:
 
 @torch.inference_mode()
 def apply_ic_light(p: "StableDiffusionProcessing", args: "ICLightArgs"):
-    sd = safetensors.torch.load_file(ICModels.get_path(args.model_type))
-
-    concat_conds = vae_encode(
-        p.sd_model,
-        numpy2pytorch(args.get_concat_cond(p)).to(dtype=dtype, device=device),
-    ).to(dtype=dtype)
-
-    concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
-
-    def apply_c_concat(unet, old_forward: Callable) -> Callable:
-        @wraps(old_forward)
-        def new_forward(x, timesteps=None, context=None, **kwargs):
-            c_concat = torch.cat(
-                ([concat_conds.to(x.device)] * (x.shape[0] // concat_conds.shape[0])),
-                dim=0,
-            )
-            new_x = torch.cat([x, c_concat], dim=1)
-            return old_forward(new_x, timesteps, context, **kwargs)
-
-        return new_forward
-
-    model_patcher = p.get_model_patcher()
-    model_patcher.add_module_patch(
-        "diffusion_model",
-        ModulePatch(create_new_forward_func=apply_c_concat),
-    )
-    model_patcher.add_patches(
-        patches={
-            "diffusion_model." + key: (value.to(dtype=dtype, device=device),)
-            for key, value in sd.items()
-        }
-    )
+    with Profiler.stage("load model"):
+        # read at every job; the computation dtype, rather than the storage one (fp8)
+        sd = ICModelCache.load(
+            ICModels.get_path(args.model_type),
+            dtype=getattr(devices, "dtype_inference", devices.dtype),
+            device=devices.device,
+            # densified once per load, then cached with the model
+            loader=compressed.load_dense,
+        )
+
+    def encode(np_concat: np.ndarray) -> torch.Tensor:
+        return encode_concat(
+            lambda x: vae_encode(p.sd_model, x),
+            numpy2pytorch(np_concat).to(dtype=dtype, device=device),
+        ).to(dtype=dtype)
+
+    with Profiler.stage("encode"):
+        concat_conds = args.get_concat_latent(p, encode, p.sd_model)
+
+    concat_conds = concat_conds.reshape(args.batch_size, -1, *concat_conds.shape[2:])
+
+    if conv_split.enabled():
+        sd, weight = conv_split.split_conv_in(sd)
+        features = ConcatFeatures(weight)
+        features.samples = concat_conds
+
+        def add_concat_features(conv, old_forward: Callable) -> Callable:
+            @wraps(old_forward)
+            def new_forward(x, *rest, **kwargs):
+                return features.add_to(old_forward(x, *rest, **kwargs))
+
+            return new_forward
+
+        module, module_patch = "diffusion_model.input_blocks.0.0", add_concat_features
+
+    else:
+
+        cond = ConcatCond()
+        cond.samples = concat_conds
+
+        def apply_c_concat(unet, old_forward: Callable) -> Callable:
+            @wraps(old_forward)
+            def new_forward(x, timesteps=None, context=None, **kwargs):
+                return old_forward(cond.concat(x), timesteps, context, **kwargs)
+
+            return new_forward
+
+        module, module_patch = "diffusion_model", apply_c_concat
+
+    with Profiler.stage("patch"):
+        model_patcher = p.get_model_patcher()
+        model_patcher.add_module_patch(
+            module, ModulePatch(create_new_forward_func=module_patch)
+        )
+        model_patcher.add_patches(
+            patches={"diffusion_model." + key: (value,) for key, value in sd.items()}
+        )
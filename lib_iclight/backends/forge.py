@@ -8,48 +8,141 @@ if TYPE_CHECKING:
 try:
     from ldm_patched.modules.model_patcher import ModelPatcher
     from ldm_patched.modules.sd import VAE
-    from ldm_patched.modules.utils import load_torch_file
 
     classic = True
 
 except ImportError:
     from backend.patcher.base import ModelPatcher
     from backend.patcher.vae import VAE
-    from backend.utils import load_torch_file
 
     classic = False
 
+import numpy as np
 import torch
 
-from modules.devices import device, dtype
+from modules.devices import dtype
+from modules.shared import opts
 
-from ..ic_light_nodes import ICLight
-from ..model_loader import ICModels
+from .. import compressed, conv_split, incremental, streaming
+from ..cache import LRUCache
+from ..ic_light_nodes import ConcatCond, ICLight
+from ..incremental import Stages
+from ..logging import logger
+from ..model_loader import ICModelCache, ICModels
+from ..profiler import Profiler
 from ..utils import forge_numpy2pytorch
+from ..vae_utils import encode_concat
 
 
-@torch.inference_mode()
-def apply_ic_light(p: "StableDiffusionProcessing", args: "ICLightArgs"):
-    sd = load_torch_file(
-        ICModels.get_path(args.model_type),
-        safe_load=True,
-        device=device,
+class PatchedUnetCache:
+    """
+    Keeps the IC-Light patched UNet resident, keyed by checkpoint, base and IC model,
+    so that consecutive jobs swap in the same ModelPatcher by reference;
+    the backend then sees the model as already loaded and skips weight patching
+    """
+
+    _cache = LRUCache(
+        "Patched UNet",
+        budget=lambda: 2 if getattr(opts, "ic_unet_cache", False) else 0,
+        keep_last=incremental.enabled,
     )
 
-    work_model: ModelPatcher = p.sd_model.forge_objects.unet.clone()
+    @staticmethod
+    def _key(
+        p: "StableDiffusionProcessing", model_type: str, base: ModelPatcher
+    ) -> tuple:
+        sd_model = p.sd_model
+        checkpoint = getattr(sd_model, "sd_model_hash", None) or getattr(
+            getattr(sd_model, "sd_checkpoint_info", None), "filename", None
+        )
+        # the entry keeps its base alive, so the id cannot be reused meanwhile
+        return (
+            checkpoint,
+            id(base),
+            ICModels.get_path(model_type),
+            conv_split.enabled(),
+            streaming.enabled(),
+        )
+
+    @classmethod
+    def _evict_stale(cls, key: tuple):
+        """
+        Drop the entries of another checkpoint or base UNet (eg. after a model
+        switch, or LoRAs replacing the base); they would pin whole UNets
+        """
+        if count := cls._cache.evict(lambda k: k[:2] != key[:2]):
+            logger.info(f"Base UNet changed; evicted {count} patched UNet(s)")
+
+    @classmethod
+    def get(
+        cls, p: "StableDiffusionProcessing", model_type: str, base: ModelPatcher
+    ) -> tuple[ModelPatcher, ConcatCond] | None:
+        key = cls._key(p, model_type, base)
+        cls._evict_stale(key)
+
+        if (entry := cls._cache.get(key)) is None:
+            return None
+
+        _, patched, cond = entry
+        return patched, cond
+
+    @classmethod
+    def put(
+        cls,
+        p: "StableDiffusionProcessing",
+        model_type: str,
+        base: ModelPatcher,
+        patched: ModelPatcher,
+        cond: ConcatCond,
+    ):
+        key = cls._key(p, model_type, base)
+        cls._evict_stale(key)
+        cls._cache.put(key, (base, patched, cond), size=1)
+
+    @classmethod
+    def clear(cls):
+        cls._cache.clear()
+
+
+@torch.inference_mode()
+def apply_ic_light(p: "StableDiffusionProcessing", args: "ICLightArgs"):
+    base: ModelPatcher = p.sd_model.forge_objects.unet
     vae: VAE = p.sd_model.forge_objects.vae
 
-    pixel_concat = (
-        forge_numpy2pytorch(args.get_concat_cond(p))
-        .to(device=vae.device, dtype=dtype)
-        .movedim(1, 3)
-    )
+    def encode(np_concat: np.ndarray) -> torch.Tensor:
+        pixel_concat = forge_numpy2pytorch(np_concat).to(device=vae.device, dtype=dtype)
+        return encode_concat(lambda x: vae.encode(x.movedim(1, 3)), pixel_concat)
 
-    patched_unet: ModelPatcher = ICLight.apply(
-        model=work_model,
-        ic_model_state_dict=sd,
-        c_concat={"samples": vae.encode(pixel_concat)},
-        mode=None if classic else args.model_type,
-    )
+    with Profiler.stage("encode"):
+        c_concat = {"samples": args.get_concat_latent(p, encode, vae)}
+
+    if (cached := PatchedUnetCache.get(p, args.model_type, base)) is not None:
+        patched_unet, cond = cached
+        ICLight.set_concat(patched_unet, cond, c_concat, args.batch_size)
+        p.sd_model.forge_objects.unet = patched_unet
+        Stages.skipped("load model")
+        Stages.skipped("patch")
+        return
+
+    stream = streaming.enabled()
+
+    with Profiler.stage("load model"):
+        sd = ICModelCache.load(
+            ICModels.get_path(args.model_type),
+            dtype=ICLight.compute_dtype(base),
+            device=torch.device("cpu") if stream else base.load_device,
+            loader=compressed.load,
+            pin=stream,
+        )
+
+    with Profiler.stage("patch"):
+        patched_unet, cond = ICLight.patch(
+            model=base.clone(),
+            ic_model_state_dict=sd,
+            mode=None if classic else args.model_type,
+            stream=stream,
+        )
+    ICLight.set_concat(patched_unet, cond, c_concat, args.batch_size)
+    PatchedUnetCache.put(p, args.model_type, base, patched_unet, cond)
 
     p.sd_model.forge_objects.unet = patched_unet
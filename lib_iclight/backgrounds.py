@@ -1,8 +1,99 @@
+from dataclasses import dataclass
 from enum import Enum
+from functools import lru_cache
+from typing import Optional
 
 import numpy as np
 
 
+@dataclass(frozen=True)
+class Light:
+    """
+    A light source for procedural light maps
+
+    - directional: a linear gradient brightest towards `angle`
+      (in degrees; 0 = from the right, 90 = from the top)
+    - spot: a radial falloff centered at (`x`, `y`) with `radius`
+      (in fractions of the width / height / shorter side)
+    - ambient: a uniform light
+    """
+
+    kind: str = "directional"
+    angle: float = 0.0
+    x: float = 0.5
+    y: float = 0.5
+    radius: float = 0.5
+    intensity: float = 1.0
+    temperature: Optional[float] = None
+    """Color Temperature in Kelvin; None = white"""
+
+    def color(self) -> np.ndarray:
+        if self.temperature is None:
+            return np.ones(3, dtype=np.float32)
+        return kelvin_to_rgb(self.temperature)
+
+    def intensity_map(self, width: int, height: int) -> np.ndarray:
+        """Returns the [H, W] intensity in 0.0 ~ 1.0, computed via broadcasting"""
+        xs = np.linspace(0.0, 1.0, width, dtype=np.float32)[None, :]
+        ys = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None]
+
+        match self.kind:
+            case "directional":
+                rad = np.deg2rad(self.angle)
+                dx, dy = np.float32(np.cos(rad)), np.float32(np.sin(rad))
+                # y axis points downwards
+                t = xs * dx - ys * dy
+                lo = min(0.0, dx) - max(0.0, dy)
+                hi = max(0.0, dx) - min(0.0, dy)
+                return (t - lo) / max(hi - lo, 1e-6)
+
+            case "spot":
+                short = np.float32(min(width, height))
+                dx = (xs - np.float32(self.x)) * (width / short)
+                dy = (ys - np.float32(self.y)) * (height / short)
+                d2 = dx * dx + dy * dy
+                return np.exp(-d2 / np.float32(2.0 * self.radius**2))
+
+            case "ambient":
+                return np.ones((1, 1), dtype=np.float32)
+
+            case _:
+                raise ValueError(f'Unknown Light "{self.kind}"')
+
+
+def kelvin_to_rgb(kelvin: float) -> np.ndarray:
+    """Approximate RGB (0.0 ~ 1.0) of a black body; by Tanner Helland"""
+    t = np.clip(kelvin, 1000.0, 40000.0) / 100.0
+
+    if t <= 66.0:
+        r = 255.0
+        g = 99.4708025861 * np.log(t) - 161.1195681661
+        b = 0.0 if t <= 19.0 else 138.5177312231 * np.log(t - 10.0) - 305.0447927307
+    else:
+        r = 329.698727446 * (t - 60.0) ** -0.1332047592
+        g = 288.1221695283 * (t - 60.0) ** -0.0755148492
+        b = 255.0
+
+    return np.clip(np.asarray([r, g, b], dtype=np.float32), 0.0, 255.0) / 255.0
+
+
+@lru_cache(maxsize=16)
+def light_map(lights: tuple[Light], width: int, height: int) -> np.ndarray:
+    """
+    Sum the lights into a [H, W, 3] uint8 light map;
+    the result is cached, and thus read-only
+    """
+    output = np.zeros((height, width, 3), dtype=np.float32)
+
+    for light in lights:
+        weight = light.color() * np.float32(light.intensity * 255.0)
+        output += light.intensity_map(width, height)[..., None] * weight
+
+    result = np.clip(output, 0.0, 255.0, out=output).astype(np.uint8)
+    result.flags.writeable = False
+    return result
+
+
 class BackgroundFC(Enum):
     """Background Source for FC Models"""
 
@@ -16,29 +107,16 @@ class BackgroundFC(Enum):
     def get_bg(self, width: int = 512, height: int = 512) -> np.ndarray:
         match self:
             case BackgroundFC.LEFT:
-                gradient = np.linspace(255, 0, width)
-                image = np.tile(gradient, (height, 1))
-                input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
-
+                lights = (Light(angle=180.0),)
             case BackgroundFC.RIGHT:
-                gradient = np.linspace(0, 255, width)
-                image = np.tile(gradient, (height, 1))
-                input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
-
+                lights = (Light(angle=0.0),)
             case BackgroundFC.TOP:
-                gradient = np.linspace(255, 0, height)[:, None]
-                image = np.tile(gradient, (1, width))
-                input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
-
+                lights = (Light(angle=90.0),)
             case BackgroundFC.BOTTOM:
-                gradient = np.linspace(0, 255, height)[:, None]
-                image = np.tile(gradient, (1, width))
-                input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
-
+                lights = (Light(angle=270.0),)
             case BackgroundFC.GREY:
-                input_bg = np.zeros((height, width, 3), dtype=np.uint8) + 127
-
+                lights = (Light(kind="ambient", intensity=127 / 255),)
             case BackgroundFC.CUSTOM:
                 return None
 
-        return input_bg
+        return light_map(lights, int(width), int(height))
@@ -0,0 +1,143 @@
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Hashable, Iterator, Optional
+
+import numpy as np
+import torch
+
+
+def nbytes(obj: Any) -> int:
+    """Memory footprint of (nested containers of) Tensors / ndarrays"""
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    return 0
+
+
+class LRUCache:
+    """Thread-safe Least-Recently-Used cache bounded by the total bytes of its values"""
+
+    _instances: weakref.WeakSet["LRUCache"] = weakref.WeakSet()
+    _scopes: int = 0
+    _scopes_lock = threading.Lock()
+
+    def __init__(
+        self,
+        name: str,
+        budget: Callable[[], int],
+        keep_last: Optional[Callable[[], bool]] = None,
+    ):
+        """
+        budget: returns the size limit in bytes;
+        read on every insertion so that it can be changed at runtime
+
+        keep_last: returns whether the latest entry is kept regardless of the budget
+        """
+        self.name = name
+        self._budget = budget
+        self._keep_last = keep_last or (lambda: False)
+        self._data: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+
+        LRUCache._instances.add(self)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> bool:
+        """Returns whether the value was stored"""
+        size = nbytes(value) if size is None else size
+        budget = self._budget()
+        keep = self._keep()
+
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            if size > budget and not keep:
+                return False
+
+            self._data[key] = (value, size)
+            self.size += size
+            self._trim(budget, keep)
+
+        return True
+
+    def evict(self, predicate: Optional[Callable[[Hashable], bool]] = None) -> int:
+        """Remove every entry whose key matches the predicate (all entries if None)"""
+        with self._lock:
+            keys = [k for k in self._data if predicate is None or predicate(k)]
+            for k in keys:
+                self.size -= self._data.pop(k)[1]
+
+        return len(keys)
+
+    def clear(self):
+        self.evict()
+
+    def enabled(self) -> bool:
+        """Whether an entry may currently be stored"""
+        return self._budget() > 0 or self._keep() > 0
+
+    def _keep(self) -> int:
+        return 1 if self._keep_last() or LRUCache._scopes > 0 else 0
+
+    @classmethod
+    @contextmanager
+    def scope(cls) -> Iterator[None]:
+        """
+        Keep the latest entry of every cache within the block, regardless of
+        the budgets; so that the jobs of one request share the prepared state
+        """
+        with cls._scopes_lock:
+            cls._scopes += 1
+        try:
+            yield
+        finally:
+            with cls._scopes_lock:
+                cls._scopes -= 1
+                done = cls._scopes == 0
+            if done:
+                for cache in list(cls._instances):
+                    cache.trim()
+
+    def trim(self):
+        """Apply the current budget"""
+        with self._lock:
+            self._trim(self._budget(), self._keep())
+
+    def _trim(self, budget: int, keep: int = 0):
+        while self.size > budget and len(self._data) > keep:
+            _, (_, size) = self._data.popitem(last=False)
+            self.size -= size
+
+    def stats(self) -> str:
+        rate = self.hits / max(self.hits + self.misses, 1)
+        return (
+            f"{self.name} Cache: {len(self._data)} entries, "
+            f"{self.size / 1024**2:.1f} MB, {self.hits} hits, {self.misses} misses, "
+            f"{rate:.0%} hit rate"
+        )
@@ -0,0 +1,321 @@
+"""
+Compressed variant of the IC-Light weights
+
+Every weight of the IC-Light models is a dense difference from the SD1 UNet;
+the converter stores each of them as either:
+- a low-rank factorization (up @ down), if accurate enough
+- the dense difference
+- nothing, if negligible
+optionally quantized to int8 / fp8 with a scale per output channel
+
+    python -m lib_iclight.compressed iclight_sd15_fc.safetensors out.safetensors \\
+        --rank 64 --quant int8 --checkpoint v1-5-pruned-emaonly.safetensors
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import NamedTuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from .safetensors_utils import mmap_load, read_header
+
+FORMAT: str = "ic-light-compressed"
+
+CONV_IN: str = "input_blocks.0.0.weight"
+"""The key of conv_in; defined here so that the converter runs without the webui"""
+
+KEEP_DENSE: tuple[str] = (CONV_IN,)
+"""conv_in is widened by the patch, which only supports dense differences"""
+
+QUANT_MAX: dict[str, float] = {"int8": 127.0, "fp8": 448.0}
+
+
+class LowRank(NamedTuple):
+    """A weight difference of `shape`, as up [out, rank] @ down [rank, in * kh * kw]"""
+
+    up: torch.Tensor
+    down: torch.Tensor
+    shape: tuple[int]
+
+    def to(self, **kwargs) -> "LowRank":
+        return LowRank(self.up.to(**kwargs), self.down.to(**kwargs), self.shape)
+
+    def dense(self) -> torch.Tensor:
+        return (self.up @ self.down).reshape(self.shape)
+
+
+def _quantize(tensor: torch.Tensor, quant: str) -> dict[str, torch.Tensor]:
+    """Symmetric quantization with a scale per output channel (ie. row)"""
+    rows = tensor.float().reshape(tensor.shape[0], -1)
+    scale = rows.abs().amax(dim=1).clamp_min(1e-12) / QUANT_MAX[quant]
+    q = rows / scale[:, None]
+
+    if quant == "int8":
+        q = q.round().clamp(-127, 127).to(torch.int8)
+    else:
+        q = q.to(torch.float8_e4m3fn)
+
+    return {"q": q.reshape(tensor.shape), "scale": scale.half()}
+
+
+def _dequantize(q: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+    rows = q.float().reshape(q.shape[0], -1) * scale.float()[:, None]
+    return rows.reshape(q.shape)
+
+
+def _store(name: str, tensor: torch.Tensor, quant: str) -> dict[str, torch.Tensor]:
+    if quant == "none":
+        return {name: tensor.half().contiguous()}
+    return {f"{name}.{k}": v.contiguous() for k, v in _quantize(tensor, quant).items()}
+
+
+def _restore(tensors: dict[str, torch.Tensor], name: str) -> torch.Tensor:
+    if name in tensors:
+        return tensors[name]
+    return _dequantize(tensors[f"{name}.q"], tensors[f"{name}.scale"])
+
+
+def factorize(
+    diff: torch.Tensor, rank: int, max_error: float
+) -> tuple[LowRank | None, float]:
+    """
+    Low-rank factorization of the difference, if it takes less space
+    and its relative error is within max_error; also returns that error
+    """
+    matrix = diff.float().reshape(diff.shape[0], -1)
+    out_dim, in_dim = matrix.shape
+    rank = min(rank, out_dim, in_dim)
+
+    if diff.ndim < 2 or rank * (out_dim + in_dim) >= out_dim * in_dim:
+        return None, 0.0
+
+    u, s, v = torch.svd_lowrank(matrix, q=min(rank + 8, out_dim, in_dim), niter=2)
+    up = u[:, :rank] * s[:rank]
+    down = v[:, :rank].T
+
+    error = float(
+        torch.linalg.matrix_norm(matrix - up @ down)
+        / torch.linalg.matrix_norm(matrix).clamp_min(1e-12)
+    )
+    if error > max_error:
+        return None, error
+
+    return LowRank(up, down, tuple(diff.shape)), error
+
+
+def compress(
+    sd: dict[str, torch.Tensor],
+    rank: int = 64,
+    max_error: float = 0.05,
+    quant: str = "none",
+    drop: float = 0.0,
+) -> tuple[dict[str, torch.Tensor], dict[str, str]]:
+    """Returns the tensors and metadata of the compressed file"""
+    tensors, shapes, kinds = {}, {}, {}
+
+    for key, diff in sd.items():
+        if drop > 0.0 and key not in KEEP_DENSE and diff.abs().max() < drop:
+            kinds[key] = "dropped"
+            continue
+
+        low_rank = None
+        if rank > 0 and key not in KEEP_DENSE:
+            low_rank, _ = factorize(diff, rank, max_error)
+
+        if low_rank is None:
+            tensors.update(_store(key, diff, quant))
+            kinds[key] = "dense"
+        else:
+            tensors.update(_store(f"{key}.up", low_rank.up, quant))
+            tensors.update(_store(f"{key}.down", low_rank.down, quant))
+            shapes[key] = list(low_rank.shape)
+            kinds[key] = "low-rank"
+
+    metadata = {
+        "format": FORMAT,
+        "quant": quant,
+        "shapes": json.dumps(shapes),
+        "kinds": json.dumps(kinds),
+    }
+    return tensors, metadata
+
+
+def unpack(
+    tensors: dict[str, torch.Tensor], metadata: dict[str, str]
+) -> dict[str, torch.Tensor | LowRank]:
+    """Dequantized weight differences; the factorized ones are returned as LowRank"""
+    shapes = json.loads(metadata["shapes"])
+
+    sd = {}
+    for key, kind in json.loads(metadata["kinds"]).items():
+        if kind == "dense":
+            sd[key] = _restore(tensors, key)
+        elif kind == "low-rank":
+            up, down = _restore(tensors, f"{key}.up"), _restore(tensors, f"{key}.down")
+            sd[key] = LowRank(up, down, tuple(shapes[key]))
+
+    return sd
+
+
+def load_compressed(
+    path: str, device: torch.device | str = "cpu"
+) -> dict[str, torch.Tensor | LowRank]:
+    with safe_open(path, framework="pt") as file:
+        metadata = file.metadata()
+    return unpack(load_file(path, device=str(device)), metadata)
+
+
+def load(path: str) -> dict[str, torch.Tensor | LowRank]:
+    """Either format of the IC-Light weights, memory-mapped on CPU"""
+    _, metadata, _ = read_header(path)
+    tensors = mmap_load(path)
+    if metadata.get("format") == FORMAT:
+        return unpack(tensors, metadata)
+    return tensors
+
+
+def load_dense(path: str) -> dict[str, torch.Tensor]:
+    """`load`, with the low-rank differences restored to dense, for A1111"""
+    return {
+        k: v.to(dtype=torch.float32).dense() if isinstance(v, LowRank) else v
+        for k, v in load(path).items()
+    }
+
+
+def report(
+    original: str,
+    compressed: str,
+    checkpoint: str = None,
+    device: str = "cpu",
+) -> dict:
+    """
+    Size, load time, patch time and error of the compressed file versus the original;
+    the error is relative to the patched weights if the SD1 checkpoint is given,
+    or to the differences otherwise
+    """
+
+    def timed(fn):
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        result = fn()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        return result, time.perf_counter() - t
+
+    dense, dense_load = timed(lambda: load_file(original, device=device))
+    packed, packed_load = timed(lambda: load_compressed(compressed, device))
+
+    base = {}
+    if checkpoint:
+        prefix = "model.diffusion_model."
+        with safe_open(checkpoint, framework="pt", device=device) as file:
+            keys = set(file.keys())
+            for key in dense:
+                if (prefix + key) in keys:
+                    base[key] = file.get_tensor(prefix + key).float()
+
+    # the weights the differences are merged into; zeros without the checkpoint
+    weights = {}
+    for key, diff in dense.items():
+        weight = base.get(key)
+        if weight is None or weight.shape != diff.shape:
+            weight = torch.zeros(diff.shape, dtype=torch.float32, device=device)
+        weights[key] = weight
+
+    def merge(sd: dict[str, torch.Tensor | LowRank]) -> dict[str, torch.Tensor]:
+        """As the backend does; the low-rank differences are restored (up @ down)"""
+        return {
+            k: weights[k] + (v.dense() if isinstance(v, LowRank) else v).float()
+            for k, v in sd.items()
+        }
+
+    _, dense_patch = timed(lambda: merge(dense))
+    _, packed_patch = timed(lambda: merge(packed))
+
+    restored = {
+        k: (v.dense() if isinstance(v, LowRank) else v).float()
+        for k, v in packed.items()
+    }
+
+    errors = {}
+    for key, diff in dense.items():
+        diff = diff.float()
+        approx = restored.get(key, torch.zeros_like(diff))
+
+        if (weight := base.get(key)) is not None and weight.shape == diff.shape:
+            reference = weight + diff
+        else:
+            reference = diff
+
+        errors[key] = float(
+            torch.linalg.vector_norm(diff - approx)
+            / torch.linalg.vector_norm(reference).clamp_min(1e-12)
+        )
+
+    with safe_open(compressed, framework="pt") as file:
+        kinds = json.loads(file.metadata()["kinds"])
+
+    ordered = sorted(errors.values())
+    return {
+        "size_mb": {
+            "original": round(os.path.getsize(original) / 1024**2, 1),
+            "compressed": round(os.path.getsize(compressed) / 1024**2, 1),
+        },
+        "load_s": {
+            "original": round(dense_load, 3),
+            "compressed": round(packed_load, 3),
+        },
+        "patch_s": {
+            "original": round(dense_patch, 3),
+            "compressed": round(packed_patch, 3),
+        },
+        "layers": {k: list(kinds.values()).count(k) for k in set(kinds.values())},
+        "relative_error": {
+            "reference": "patched weights" if base else "differences",
+            "mean": sum(ordered) / max(len(ordered), 1),
+            "p95": ordered[int(len(ordered) * 0.95)] if ordered else 0.0,
+            "max": ordered[-1] if ordered else 0.0,
+            "worst": max(errors, key=errors.get) if errors else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input", type=str, help="original IC-Light model")
+    parser.add_argument("output", type=str, help="compressed model")
+    parser.add_argument("--rank", type=int, default=64, help="0 = no factorization")
+    parser.add_argument(
+        "--max-error",
+        type=float,
+        default=0.05,
+        help="keep the difference dense above this relative error of the factorization",
+    )
+    parser.add_argument("--quant", choices=("none", "int8", "fp8"), default="none")
+    parser.add_argument(
+        "--drop",
+        type=float,
+        default=0.0,
+        help="drop the differences whose largest magnitude is below this",
+    )
+    parser.add_argument("--checkpoint", type=str, default=None, help="SD1 checkpoint")
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    sd = load_file(args.input, device=args.device)
+    tensors, metadata = compress(sd, args.rank, args.max_error, args.quant, args.drop)
+    save_file({k: v.cpu() for k, v in tensors.items()}, args.output, metadata)
+    del sd, tensors
+
+    result = report(args.input, args.output, args.checkpoint, args.device)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import torch
+
+
+class ConcatCond:
+    """
+    Mutable concat conditioning read by the UNet wrapper;
+    the tensors derived from it are built once and reused at every step
+    """
+
+    def __init__(self):
+        self._samples: torch.Tensor = None
+        self._derived: dict[tuple, torch.Tensor] = {}
+
+    @property
+    def samples(self) -> torch.Tensor:
+        return self._samples
+
+    @samples.setter
+    def samples(self, samples: torch.Tensor):
+        """concat conditioning in [batch, C, H, W] format"""
+        self._samples = samples
+        self._derived.clear()
+
+    def repeated(self, x: torch.Tensor, dtype: torch.dtype = None) -> torch.Tensor:
+        """The conditioning repeated to the batch of x (eg. cond + uncond)"""
+        repeat = x.shape[0] // self._samples.shape[0]
+        dtype = dtype or self._samples.dtype
+        key = ("repeated", repeat, x.device, dtype)
+
+        if (repeated := self._derived.get(key)) is None:
+            repeated = self._samples.to(device=x.device, dtype=dtype)
+            repeated = self._derived[key] = repeated.repeat(repeat, 1, 1, 1)
+
+        return repeated
+
+    def concat(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        torch.cat([x, repeated], dim=1), written into a buffer reused across steps;
+        only valid until the next call
+        """
+        key = ("concat", x.shape, x.device, x.dtype)
+
+        if (buffer := self._derived.get(key)) is None:
+            repeated = self.repeated(x, x.dtype)
+            shape = (x.shape[0], x.shape[1] + repeated.shape[1], *x.shape[2:])
+            buffer = torch.empty(shape, dtype=x.dtype, device=x.device)
+            buffer[:, x.shape[1] :].copy_(repeated)
+            self._derived[key] = buffer
+
+        buffer[:, : x.shape[1]].copy_(x)
+        return buffer
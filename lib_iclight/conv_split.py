@@ -0,0 +1,58 @@
+import torch
+import torch.nn.functional as F
+
+from modules.shared import opts
+
+from .compressed import CONV_IN
+from .concat_cond import ConcatCond
+
+LATENT_CHANNELS: int = 4
+
+
+def enabled() -> bool:
+    return getattr(opts, "ic_split_conv_in", False)
+
+
+def split_conv_in(
+    sd: dict[str, torch.Tensor],
+) -> tuple[dict[str, torch.Tensor], torch.Tensor]:
+    """
+    conv(cat(x, c), W) = conv(x, W[:, :4]) + conv(c, W[:, 4:])
+
+    Returns the state dict with the conv_in weight of the latent channels only,
+    so that the UNet keeps its original input channels;
+    and the conv_in weight of the concat channels
+    """
+    weight = sd[CONV_IN]
+    sd = dict(sd)
+    sd[CONV_IN] = weight[:, :LATENT_CHANNELS].contiguous()
+    return sd, weight[:, LATENT_CHANNELS:].contiguous()
+
+
+class ConcatFeatures(ConcatCond):
+    """
+    The conv_in contribution of the concat conditioning,
+    computed once per conditioning and added to the conv_in output at every step
+    """
+
+    def __init__(self, weight: torch.Tensor):
+        super().__init__()
+        self.weight = weight
+
+    def features(self, h: torch.Tensor) -> torch.Tensor:
+        """The contribution for h, the [repeat * batch, 320, H, W] conv_in output"""
+        repeat = h.shape[0] // self._samples.shape[0]
+        key = ("features", repeat, h.dtype, h.device)
+
+        if (features := self._derived.get(key)) is None:
+            weight = self.weight.to(h)
+            features = F.conv2d(
+                self._samples.to(h), weight, padding=weight.shape[-1] // 2
+            )
+            features = self._derived[key] = features.repeat(repeat, 1, 1, 1)
+
+        return features
+
+    def add_to(self, h: torch.Tensor) -> torch.Tensor:
+        """In-place, as h is the freshly computed conv_in output"""
+        return h.add_(self.features(h))
@@ -5,36 +5,143 @@
 
 import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
 from PIL import Image
 
 from modules.images import resize_image
 
+from .utils import resize_and_center_crop
+
 
 def resize_input(img: np.ndarray, h: int, w: int, mode: int = 1) -> np.ndarray:
+    if mode == 1:  # Crop & Resize
+        # the Resize Backend of the Settings, instead of the webui upscaler
+        return np.ascontiguousarray(resize_and_center_crop(img, w, h)[..., :3])
+
     img = Image.fromarray(img)
-    resized_img: Image.Image = resize_image(mode, img, w, h)  # Crop & Resize
+    resized_img: Image.Image = resize_image(mode, img, w, h)
 
     return np.asarray(resized_img.convert("RGB"), dtype=np.uint8)
 
 
+SMALL_GAUSSIAN_KERNELS: dict[int, tuple[float]] = {
+    1: (1.0,),
+    3: (0.25, 0.5, 0.25),
+    5: (0.0625, 0.25, 0.375, 0.25, 0.0625),
+    7: (0.03125, 0.109375, 0.21875, 0.28125, 0.21875, 0.109375, 0.03125),
+}
+"""OpenCV uses fixed kernels for small sizes when sigma is 0"""
+
+
+def gaussian_kernel(ksize: int) -> torch.Tensor:
+    """1D kernel identical to cv2.getGaussianKernel(ksize, 0)"""
+    if ksize in SMALL_GAUSSIAN_KERNELS:
+        return torch.tensor(SMALL_GAUSSIAN_KERNELS[ksize], dtype=torch.float32)
+
+    sigma = 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+    x = torch.arange(ksize, dtype=torch.float64) - (ksize - 1) / 2
+    kernel = torch.exp(-(x**2) / (2 * sigma**2))
+    return (kernel / kernel.sum()).float()
+
+
+def gaussian_blur(images: torch.Tensor, ksize: int) -> torch.Tensor:
+    """Separable Gaussian blur of [B, C, H, W] images, with the same border as cv2"""
+    if ksize <= 1:
+        return images.clone()
+
+    c = images.shape[1]
+    kernel = gaussian_kernel(ksize).to(images)
+    pad = ksize // 2
+
+    x = F.pad(images, (pad, pad, pad, pad), mode="reflect")
+    x = F.conv2d(x, kernel.view(1, 1, 1, -1).expand(c, 1, 1, -1), groups=c)
+    x = F.conv2d(x, kernel.view(1, 1, -1, 1).expand(c, 1, -1, 1), groups=c)
+    return x
+
+
+class DetailRestorer:
+    """
+    Difference of Gaussian detail transfer:
+        output = original + (blur(ic_light) - blur(original))
+               = blur(ic_light) + (original - blur(original))
+
+    The (original - blur(original)) term only depends on the output resolution,
+    so it is computed once and shared by every image of the job
+    """
+
+    def __init__(self, original: np.ndarray, blur_radius: int):
+        self.original = original
+        self.radius = blur_radius
+        self._details: dict[tuple[int, int], np.ndarray] = {}
+        self._buffer: np.ndarray = None
+
+    def _blur(self, image: np.ndarray) -> np.ndarray:
+        """In-place Gaussian blur"""
+        return cv2.GaussianBlur(image, (self.radius, self.radius), 0, dst=image)
+
+    def detail(self, h: int, w: int) -> np.ndarray:
+        """Returns (original - blur(original)) in [H, W, 3] float32 format, 0 ~ 255"""
+        if (detail := self._details.get((h, w))) is None:
+            original = resize_input(self.original, h, w).astype(np.float32)
+            detail = np.subtract(original, self._blur(original.copy()), out=original)
+            self._details[(h, w)] = detail
+
+        return detail
+
+    def detail_tensor(self, h: int, w: int, device: torch.device) -> torch.Tensor:
+        """Returns (original - blur(original)) in [3, H, W] format, 0.0 ~ 1.0"""
+        key = (h, w, str(device))
+        if (detail := self._details.get(key)) is None:
+            original = torch.from_numpy(resize_input(self.original, h, w).copy())
+            original = original.to(device=device, dtype=torch.float32).div_(255.0)
+            original = original.movedim(-1, 0)[None, ...]
+            detail = (original - gaussian_blur(original, self.radius))[0]
+            self._details[key] = detail
+
+        return detail
+
+    def restore(self, ic_light_image: np.ndarray) -> Image.Image:
+        h, w, c = ic_light_image.shape
+        if c == 4:
+            ic_light_image = cv2.cvtColor(ic_light_image, cv2.COLOR_RGBA2RGB)
+
+        if self._buffer is None or self._buffer.shape != (h, w, 3):
+            self._buffer = np.empty((h, w, 3), dtype=np.float32)
+
+        buffer = self._buffer
+        np.copyto(buffer, ic_light_image, casting="unsafe")
+        self._blur(buffer)
+        buffer += self.detail(h, w)
+        np.clip(buffer, 0.0, 255.0, out=buffer)
+        np.rint(buffer, out=buffer)
+
+        return Image.fromarray(buffer.astype(np.uint8))
+
+
 def restore_detail(
     ic_light_image: np.ndarray,
     original_image: np.ndarray,
     blur_radius: int,
 ) -> Image.Image:
-    h, w, c = ic_light_image.shape
-    if c == 4:
-        ic_light_image = cv2.cvtColor(ic_light_image, cv2.COLOR_RGBA2RGB)
-
-    original_image = resize_input(original_image, h, w)
+    return DetailRestorer(original_image, blur_radius).restore(ic_light_image)
 
-    ic_light_image = ic_light_image.astype(np.float32) / 255.0
-    original_image = original_image.astype(np.float32) / 255.0
 
-    blurred_ic_light = cv2.GaussianBlur(ic_light_image, (blur_radius, blur_radius), 0)
-    blurred_original = cv2.GaussianBlur(original_image, (blur_radius, blur_radius), 0)
+@torch.inference_mode()
+def restore_detail_batch(
+    images: torch.Tensor,
+    restorers: list[DetailRestorer],
+    device: torch.device,
+) -> list[Image.Image]:
+    """
+    Restore the details of the decoded [B, 3, H, W] images (0.0 ~ 1.0) on the device,
+    where restorers[i] holds the original of images[i]
+    """
+    x = images.to(device=device, dtype=torch.float32)
+    _, _, h, w = x.shape
 
-    DoG = original_image + (blurred_ic_light - blurred_original)
-    DoG = np.clip(DoG * 255.0, 0, 255).round().astype(np.uint8)
+    details = torch.stack([r.detail_tensor(h, w, device) for r in restorers])
+    x = gaussian_blur(x, restorers[0].radius).add_(details)
+    x = x.mul_(255.0).clamp_(0.0, 255.0).round_().to(torch.uint8)
 
-    return Image.fromarray(DoG)
+    return [Image.fromarray(image) for image in x.movedim(1, -1).cpu().numpy()]
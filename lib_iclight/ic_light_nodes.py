@@ -2,7 +2,13 @@ from typing import Callable, Optional, TypedDict
 
 import torch
 
-from modules.devices import device, dtype
+from modules import devices
+
+from . import conv_split
+from .compressed import LowRank
+from .concat_cond import ConcatCond
+from .conv_split import ConcatFeatures
+from .streaming import PatchStream
 
 try:
     from ldm_patched.modules.model_patcher import ModelPatcher
@@ -20,59 +26,129 @@ class UnetParams(TypedDict):
 class ICLight:
     """IC-Light Implementation"""
 
+    @staticmethod
+    def compute_dtype(model: ModelPatcher) -> torch.dtype:
+        """
+        The dtype the UNet computes in; its weights may be stored in a lower one
+        (fp8 / nf4 / gguf), which would round the small IC-Light differences away
+        """
+        for attr in ("computation_dtype", "manual_cast_dtype"):
+            if isinstance(dtype := getattr(model.model, attr, None), torch.dtype):
+                return dtype
+        return devices.dtype
+
     @staticmethod
     def apply(
         model: ModelPatcher,
         ic_model_state_dict: dict[str, torch.Tensor],
         c_concat: dict,
         mode: Optional[str] = None,
+        batch: int = 1,
     ) -> ModelPatcher:
-        work_model = model.clone()
+        work_model, cond = ICLight.patch(model, ic_model_state_dict, mode)
+        ICLight.set_concat(work_model, cond, c_concat, batch)
+        return work_model
 
+    @staticmethod
+    def set_concat(
+        model: ModelPatcher,
+        cond: ConcatCond,
+        c_concat: dict,
+        batch: int = 1,
+    ):
+        """
+        c_concat: latents in [batch * N, C, H, W] format,
+        where each batch item has N consecutive images stacked along the channels
+        """
         model_config = (
-            work_model.model.model_config
-            if hasattr(work_model.model, "model_config")
-            else work_model.model.config
+            model.model.model_config
+            if hasattr(model.model, "model_config")
+            else model.model.config
         )
         scale_factor: float = model_config.latent_format.scale_factor
 
         concat_conds: torch.Tensor = c_concat["samples"] * scale_factor
-        concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
-
-        def apply_c_concat(params: UnetParams) -> UnetParams:
-            """Apply c_concat on Unet call"""
-            sample = params["input"]
-            params["c"]["c_concat"] = torch.cat(
-                (
-                    [concat_conds.to(sample.device)]
-                    * (sample.shape[0] // concat_conds.shape[0])
-                ),
-                dim=0,
-            )
-            return params
+        cond.samples = concat_conds.reshape(batch, -1, *concat_conds.shape[2:])
 
-        def unet_dummy_apply(unet_apply: Callable, params: UnetParams) -> Callable:
-            """A dummy unet apply wrapper serving as the endpoint of wrapper chain"""
-            return unet_apply(x=params["input"], t=params["timestep"], **params["c"])
+    @staticmethod
+    def _patch(value: torch.Tensor | LowRank) -> tuple:
+        """A dense difference, or a low-rank one from the compressed format"""
+        if isinstance(value, LowRank):
+            return ("lora", (value.up, value.down, None, None, None))
+        return (value,)
 
-        existing_wrapper = work_model.model_options.get(
-            "model_function_wrapper", unet_dummy_apply
-        )
+    @staticmethod
+    def patch(
+        model: ModelPatcher,
+        ic_model_state_dict: dict[str, torch.Tensor | LowRank],
+        mode: Optional[str] = None,
+        stream: bool = False,
+    ) -> tuple[ModelPatcher, ConcatCond]:
+        """
+        Patch the IC-Light weights; the concat conditioning is set via `set_concat`
 
-        def wrapper_func(unet_apply: Callable, params: UnetParams) -> Callable:
-            return existing_wrapper(unet_apply, params=apply_c_concat(params))
+        With the split conv_in, the UNet keeps its 4 input channels,
+        and the contribution of the concat channels is added after conv_in
 
-        work_model.set_model_unet_function_wrapper(wrapper_func)
+        With `stream`, the weights stay on the host, and are streamed to the device
+        layer by layer when the backend merges them (see `PatchStream`)
+        """
+        work_model = model.clone()
+        # the UNet being patched, rather than the defaults of the webui
+        dtype, device = ICLight.compute_dtype(work_model), work_model.load_device
+
+        if conv_split.enabled() and hasattr(work_model, "set_model_patch"):
+            ic_model_state_dict, weight = conv_split.split_conv_in(ic_model_state_dict)
+            cond = ConcatFeatures(weight.to(dtype=dtype, device=device))
+
+            def add_concat_features(h: torch.Tensor, transformer_options: dict):
+                """Add the conv_in contribution of c_concat after the first block"""
+                if transformer_options.get("block") == ("input", 0):
+                    return cond.add_to(h)
+                return h
+
+            work_model.set_model_patch(add_concat_features, "input_block_patch")
+
+        else:
+            cond = ConcatCond()
+
+            def apply_c_concat(params: UnetParams) -> UnetParams:
+                """Apply c_concat on Unet call"""
+                params["c"]["c_concat"] = cond.repeated(params["input"])
+                return params
+
+            def unet_dummy_apply(unet_apply: Callable, params: UnetParams) -> Callable:
+                """A dummy unet apply wrapper serving as the endpoint of wrapper chain"""
+                return unet_apply(
+                    x=params["input"], t=params["timestep"], **params["c"]
+                )
 
+            existing_wrapper = work_model.model_options.get(
+                "model_function_wrapper", unet_dummy_apply
+            )
+
+            def wrapper_func(unet_apply: Callable, params: UnetParams) -> Callable:
+                return existing_wrapper(unet_apply, params=apply_c_concat(params))
+
+            work_model.set_model_unet_function_wrapper(wrapper_func)
+
+        sd = {
+            key: value.to(dtype=dtype, device="cpu" if stream else device)
+            for key, value in ic_model_state_dict.items()
+        }
         args = {
             "patches": {
-                ("diffusion_model." + key): (value.to(dtype=dtype, device=device),)
-                for key, value in ic_model_state_dict.items()
+                ("diffusion_model." + key): ICLight._patch(value)
+                for key, value in sd.items()
             }
         }
 
+        if stream and PatchStream.install():
+            # kept alive by the patched model, along with its patches
+            work_model.ic_light_stream = PatchStream(args["patches"].values(), device)
+
         if mode is not None:
             args["filename"] = f"ic-light-{mode}"
 
         work_model.add_patches(**args)
-        return work_model
+        return work_model, cond
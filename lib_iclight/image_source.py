@@ -0,0 +1,153 @@
+import base64
+import io
+import os
+from multiprocessing import shared_memory
+from typing import Any
+
+import numpy as np
+from PIL import Image
+
+from modules.api.api import decode_base64_to_image
+from modules.shared import opts
+
+
+class LazyImage:
+    """
+    Handle to an input image, decoded on first access
+
+    Accepted sources:
+    - np.ndarray
+    - str: base64 encoded image
+    - bytes: encoded image (png / jpg / ...)
+    - dict with "data" (bytes or base64 str of the raw pixels), "shape" and "dtype"
+    - dict with "path" to an image file; requires the local inputs setting
+    - dict with "shm" (name of a shared memory block), "shape" and "dtype";
+      requires the local inputs setting
+    - dict with "npy" path to a .npy file; requires the local inputs setting
+
+    The shared memory blocks (on POSIX) and the .npy files are mapped read-only
+    without copying, and remain mapped for as long as the array is referenced
+    """
+
+    def __init__(self, source: Any):
+        self._source = source
+        self._image: np.ndarray = source if isinstance(source, np.ndarray) else None
+
+    @property
+    def is_none(self) -> bool:
+        return self._source is None and self._image is None
+
+    @property
+    def image(self) -> np.ndarray | None:
+        if self._image is None and self._source is not None:
+            self._image = self.decode(self._source)
+            self._source = None
+        return self._image
+
+    def release(self):
+        """Free the decoded buffer"""
+        self._source = None
+        self._image = None
+
+    @staticmethod
+    def decode(source: Any) -> np.ndarray:
+        if isinstance(source, np.ndarray):
+            return source
+        if isinstance(source, str):
+            return np.asarray(decode_base64_to_image(source), dtype=np.uint8)
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return np.asarray(Image.open(io.BytesIO(source)), dtype=np.uint8)
+        if isinstance(source, dict):
+            return LazyImage._decode_dict(source)
+
+        raise TypeError(f'Unsupported image source "{type(source).__name__}"')
+
+    @staticmethod
+    def _decode_dict(source: dict) -> np.ndarray:
+        if "data" in source:
+            data = source["data"]
+            if isinstance(data, str):
+                data = base64.b64decode(data)
+            dtype = np.dtype(source.get("dtype", "uint8"))
+            return np.frombuffer(data, dtype=dtype).reshape(source["shape"])
+
+        if not getattr(opts, "ic_local_inputs", False):
+            raise PermissionError("Local image inputs are disabled in the Settings")
+
+        if "path" in source:
+            with Image.open(source["path"]) as image:
+                return np.asarray(image, dtype=np.uint8)
+
+        if "npy" in source:
+            return np.load(source["npy"], mmap_mode="r", allow_pickle=False)
+
+        if "shm" in source:
+            dtype = np.dtype(source.get("dtype", "uint8"))
+            shape = tuple(source["shape"])
+
+            if (path := shm_path(source["shm"])) is not None:
+                return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+            shm = shared_memory.SharedMemory(name=source["shm"])
+            try:
+                # the temporary view must be gone before closing the block
+                return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+            finally:
+                shm.close()
+
+        raise ValueError(f"Unsupported image source {list(source.keys())}")
+
+
+SHM_ROOT: str = "/dev/shm"
+"""Where POSIX shared memory blocks are exposed as files"""
+
+
+def shm_path(name: str) -> str | None:
+    """File of the shared memory block; None if not available on this platform"""
+    name = name.lstrip("/")
+    if not name or os.path.basename(name) != name:
+        raise ValueError(f'Invalid shared memory name "{name}"')
+    if not os.path.isdir(SHM_ROOT):
+        return None
+    return os.path.join(SHM_ROOT, name)
+
+
+def export_images(images: list, target: dict) -> list[dict]:
+    """
+    Write the images as raw [H, W, C] uint8 arrays, for callers on the same machine;
+    target is either {"shm": prefix} or {"npy": directory}
+
+    Returns the sources of the written images, in the format accepted by LazyImage;
+    the caller is responsible for removing them
+    """
+    if not getattr(opts, "ic_local_inputs", False):
+        raise PermissionError("Local image outputs are disabled in the Settings")
+
+    if "npy" in target:
+        os.makedirs(target["npy"], exist_ok=True)
+
+    outputs = []
+    for index, image in enumerate(images):
+        array = np.asarray(image, dtype=np.uint8)
+
+        if "npy" in target:
+            path = os.path.join(target["npy"], f"{index:05}.npy")
+            np.save(path, array, allow_pickle=False)
+            outputs.append({"npy": path, "shape": array.shape, "dtype": "uint8"})
+            continue
+
+        if "shm" not in target:
+            raise ValueError(f"Unsupported output target {list(target.keys())}")
+
+        name = f"{target['shm']}_{index:05}"
+        if (path := shm_path(name)) is None:
+            raise OSError("Shared memory outputs require a POSIX system")
+
+        mapped = np.memmap(path, dtype=np.uint8, mode="w+", shape=array.shape)
+        mapped[...] = array
+        mapped.flush()
+        del mapped
+
+        outputs.append({"shm": name, "shape": array.shape, "dtype": "uint8"})
+
+    return outputs
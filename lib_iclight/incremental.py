@@ -0,0 +1,82 @@
+import hashlib
+import os
+from typing import Any
+
+import numpy as np
+from PIL import Image
+
+from modules.shared import opts
+
+from .image_source import LazyImage
+from .logging import logger
+from .utils import hash_array
+
+
+def enabled() -> bool:
+    return getattr(opts, "ic_incremental", False)
+
+
+def fingerprint(*parts: Any) -> str:
+    """
+    Content hash of the inputs of a stage;
+    images are hashed by content, and files by path and modification time
+    """
+    h = hashlib.blake2b(digest_size=16)
+
+    def update(part: Any):
+        if isinstance(part, np.ndarray):
+            h.update(hash_array(part).encode())
+        elif isinstance(part, Image.Image):
+            h.update(hash_array(np.asarray(part)).encode())
+        elif isinstance(part, (bytes, bytearray, memoryview)):
+            h.update(part)
+        elif isinstance(part, str):
+            h.update(part.encode())
+        elif isinstance(part, (list, tuple)):
+            h.update(f"[{len(part)}]".encode())
+            for p in part:
+                update(p)
+        elif isinstance(part, dict):
+            for key in sorted(part):
+                h.update(f"{key}=".encode())
+                update(part[key])
+            for key in ("path", "npy"):
+                if isinstance(part.get(key), str) and os.path.isfile(part[key]):
+                    h.update(str(os.path.getmtime(part[key])).encode())
+            if "shm" in part:
+                # the block may be rewritten under the same name
+                update(LazyImage.decode(part))
+        else:
+            h.update(repr(part).encode())
+        h.update(b"|")
+
+    for part in parts:
+        update(part)
+
+    return h.hexdigest()
+
+
+class Stages:
+    """Records which stages of the current job were reused from the previous jobs"""
+
+    _skipped: list[str] = None
+
+    @classmethod
+    def begin_job(cls):
+        cls._skipped = []
+
+    @classmethod
+    def skipped(cls, name: str):
+        if cls._skipped is not None and name not in cls._skipped:
+            cls._skipped.append(name)
+
+    @classmethod
+    def end_job(cls):
+        if cls._skipped is None:
+            return
+
+        skipped, cls._skipped = cls._skipped, None
+        if skipped:
+            logger.info(f"Skipped stages: {', '.join(skipped)}")
+        else:
+            logger.debug("Skipped stages: none")
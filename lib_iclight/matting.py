@@ -0,0 +1,106 @@
+import cv2
+import numpy as np
+
+MATTING: tuple[str] = ("pymatting", "guided filter", "none")
+"""
+- pymatting: closed-form matting of rembg; accurate, but slow on large inputs
+- guided filter: refines the mask along the edges of the image; fast
+- none: the post-processed mask of rembg as is
+"""
+
+GUIDED_EPS: float = 1e-4
+GUIDED_MAX_SIZE: int = 1024
+"""The coefficients are computed at this resolution at most, then upsampled"""
+
+
+def guided_filter(
+    guide: np.ndarray,
+    src: np.ndarray,
+    radius: int,
+    eps: float = GUIDED_EPS,
+    scale: int = 1,
+) -> np.ndarray:
+    """
+    Fast Guided Filter (He et al.) of float32 [H, W] arrays, 0.0 ~ 1.0;
+    the linear coefficients are computed at 1 / scale of the resolution
+    """
+    h, w = guide.shape
+    if scale > 1:
+        size = (max(1, w // scale), max(1, h // scale))
+        g = cv2.resize(guide, size, interpolation=cv2.INTER_AREA)
+        p = cv2.resize(src, size, interpolation=cv2.INTER_AREA)
+        radius = max(1, radius // scale)
+    else:
+        g, p = guide, src
+
+    ksize = (2 * radius + 1, 2 * radius + 1)
+
+    def mean(x: np.ndarray) -> np.ndarray:
+        return cv2.boxFilter(x, -1, ksize)
+
+    mean_g, mean_p = mean(g), mean(p)
+    cov_gp = mean(g * p) - mean_g * mean_p
+    var_g = mean(g * g) - mean_g * mean_g
+
+    a = cov_gp / (var_g + eps)
+    b = mean_p - a * mean_g
+    mean_a, mean_b = mean(a), mean(b)
+
+    if scale > 1:
+        mean_a = cv2.resize(mean_a, (w, h), interpolation=cv2.INTER_LINEAR)
+        mean_b = cv2.resize(mean_b, (w, h), interpolation=cv2.INTER_LINEAR)
+
+    return mean_a * guide + mean_b
+
+
+def trimap(
+    mask: np.ndarray,
+    foreground_threshold: int,
+    background_threshold: int,
+    erode_size: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """The definite foreground and background of the [H, W] uint8 mask"""
+    fg = (mask >= foreground_threshold).astype(np.uint8)
+    bg = (mask <= background_threshold).astype(np.uint8)
+
+    if erode_size > 0:
+        kernel = np.ones((erode_size, erode_size), dtype=np.uint8)
+        fg = cv2.erode(fg, kernel, borderType=cv2.BORDER_CONSTANT, borderValue=0)
+        bg = cv2.erode(bg, kernel, borderType=cv2.BORDER_CONSTANT, borderValue=0)
+
+    return fg.astype(bool), bg.astype(bool)
+
+
+def refine_alpha(
+    image: np.ndarray,
+    mask: np.ndarray,
+    foreground_threshold: int,
+    background_threshold: int,
+    erode_size: int,
+) -> np.ndarray:
+    """
+    Refine the [H, W] uint8 mask along the edges of the [H, W, 3] uint8 image;
+    only the unknown region of the trimap is changed
+    """
+    h, w = mask.shape
+    guide = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY).astype(np.float32) / 255.0
+    src = mask.astype(np.float32) / 255.0
+
+    alpha = guided_filter(
+        guide,
+        src,
+        radius=max(1, erode_size // 2),
+        scale=max(1, max(h, w) // GUIDED_MAX_SIZE),
+    )
+
+    fg, bg = trimap(mask, foreground_threshold, background_threshold, erode_size)
+    alpha[fg] = 1.0
+    alpha[bg] = 0.0
+
+    return (np.clip(alpha, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+
+
+def upsample_mask(mask: np.ndarray, w: int, h: int) -> np.ndarray:
+    if mask.shape == (h, w):
+        return mask
+    return cv2.resize(mask, (w, h), interpolation=cv2.INTER_LINEAR)
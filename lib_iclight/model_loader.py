@@ -1,14 +1,83 @@
+import json
+import os
+from typing import TYPE_CHECKING, Callable, NamedTuple
+
+from modules.shared import opts
+
+from . import incremental, streaming
+from .cache import LRUCache
+from .compressed import FORMAT
+from .conv_split import CONV_IN
+from .incremental import Stages
 from .logging import logger
+from .safetensors_utils import read_header
+
+if TYPE_CHECKING:
+    import torch
+
+KINDS: dict[int, str] = {8: "fc", 12: "fbc"}
+"""Input channels of conv_in of each IC-Light model (latent + concat)"""
+
+
+class ModelInfo(NamedTuple):
+    path: str
+    kind: str
+    compressed: bool
+
+
+def classify(path: str) -> tuple[str, bool]:
+    """(kind, compressed) of the model, from its safetensors header only"""
+    header, metadata, _ = read_header(path)
+
+    for key, entry in header.items():
+        # the quantized variant stores the weight as "<key>.q"
+        if key.removesuffix(".q").endswith(CONV_IN):
+            channels = entry["shape"][1]
+            if channels not in KINDS:
+                raise ValueError(f"Unknown conv_in channels ({channels})")
+            return KINDS[channels], metadata.get("format") == FORMAT
+
+    raise ValueError("Missing conv_in weight")
 
 
 class ICModels:
+    """
+    Every IC-Light model in the folder, keyed by filename (without extension);
+    the models are classified by their conv_in, and the results are kept in an
+    index file keyed by size and modification time, so that only the new or
+    changed files are read on startup
+    """
+
     _init: bool = False
 
+    models: dict[str, ModelInfo] = {}
+
     fc: str = ""
     fbc: str = ""
+    """The default model of each kind"""
+
+    INDEX: str = "index.json"
+    VERSION: int = 1
+
+    @classmethod
+    def _read_index(cls, path: str) -> dict[str, dict]:
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+        if index.get("version") != cls.VERSION:
+            return {}
+        return index.get("models", {})
 
-    fc_path: str = None
-    fbc_path: str = None
+    @classmethod
+    def _write_index(cls, path: str, entries: dict[str, dict]):
+        try:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump({"version": cls.VERSION, "models": entries}, file, indent=2)
+        except OSError as e:
+            logger.warning(f"Failed to write the IC-Light model index: {e}")
 
     @classmethod
     def detect_models(cls):
@@ -17,39 +86,122 @@ class ICModels:
         else:
             cls._init = True
 
-        import os
-
         from modules.paths import models_path
 
         folder = os.path.join(models_path, "ic-light")
         os.makedirs(folder, exist_ok=True)
 
-        fc, fbc = None, None
+        index_path = os.path.join(folder, cls.INDEX)
+        index = cls._read_index(index_path)
+        entries: dict[str, dict] = {}
 
-        for obj in os.listdir(folder):
+        for obj in sorted(os.listdir(folder)):
             if not obj.endswith(".safetensors"):
                 continue
-            if "fc" in obj.lower():
-                fc = os.path.join(folder, obj)
-            if "fbc" in obj.lower():
-                fbc = os.path.join(folder, obj)
 
-        if fc is None or fbc is None:
-            logger.error("Failed to locate IC-Light models! Download from Releases!")
-            return
+            path = os.path.join(folder, obj)
+            stat = os.stat(path)
 
-        cls.fc: str = os.path.basename(fc).rsplit(".", 1)[0]
-        cls.fc_path: str = fc
+            entry = index.get(obj)
+            if entry is None or (entry["size"], entry["mtime"]) != (
+                stat.st_size,
+                stat.st_mtime,
+            ):
+                try:
+                    kind, compressed = classify(path)
+                except (OSError, ValueError) as e:
+                    # also indexed, so that it is not read again until changed
+                    logger.warning(f'Skipping "{obj}": {e}')
+                    kind, compressed = None, False
 
-        cls.fbc: str = os.path.basename(fbc).rsplit(".", 1)[0]
-        cls.fbc_path: str = fbc
+                entry = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                    "kind": kind,
+                    "compressed": compressed,
+                }
+
+            entries[obj] = entry
+            if entry["kind"] is None:
+                continue
+
+            cls.models[obj.rsplit(".", 1)[0]] = ModelInfo(
+                path, entry["kind"], entry["compressed"]
+            )
+
+        if entries != index:
+            cls._write_index(index_path, entries)
+
+        cls.fc = next(iter(cls.choices("fc")), "")
+        cls.fbc = next(iter(cls.choices("fbc")), "")
+
+        if not (cls.fc and cls.fbc):
+            logger.error("Failed to locate IC-Light models! Download from Releases!")
+
+    @classmethod
+    def choices(cls, kind: str = None) -> list[str]:
+        """The models of the kind (or all models), uncompressed first"""
+        return sorted(
+            (name for name, info in cls.models.items() if kind in (None, info.kind)),
+            key=lambda name: (cls.models[name].compressed, name),
+        )
 
     @classmethod
     def get_path(cls, model: str) -> str:
-        match model:
-            case cls.fc:
-                return cls.fc_path
-            case cls.fbc:
-                return cls.fbc_path
-            case _:
-                raise ValueError
+        if (info := cls.models.get(model)) is None:
+            raise ValueError
+        return info.path
+
+    @classmethod
+    def get_kind(cls, model: str) -> str:
+        """Either fc or fbc"""
+        if (info := cls.models.get(model)) is None:
+            raise ValueError
+        return info.kind
+
+
+class ICModelCache:
+    """Keeps the IC-Light state dicts, cast to the target dtype & device, across jobs"""
+
+    _cache = LRUCache(
+        "IC-Light Model",
+        budget=lambda: int(getattr(opts, "ic_model_cache", 0)) * 1024**2,
+        keep_last=incremental.enabled,
+    )
+    _target: tuple["torch.dtype", "torch.device"] = None
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        dtype: "torch.dtype",
+        device: "torch.device",
+        loader: Callable[[str], dict[str, "torch.Tensor"]],
+        pin: bool = False,
+    ) -> dict[str, "torch.Tensor"]:
+        """
+        dtype / device: those of the UNet being patched, read at every job
+        pin: keep the tensors in page-locked host memory (device must be CPU)
+        """
+        if cls._target != (dtype, device):
+            if cls._target is not None and (count := cls._cache.evict()):
+                logger.info(f"UNet dtype/device changed; evicted {count} model(s)")
+            cls._target = (dtype, device)
+
+        key = (path, os.path.getmtime(path), dtype, device, pin)
+
+        if (sd := cls._cache.get(key)) is not None:
+            logger.info(f'Reusing "{os.path.basename(path)}" ({cls._cache.stats()})')
+            Stages.skipped("load model")
+            return sd
+
+        sd = {k: v.to(dtype=dtype, device=device) for k, v in loader(path).items()}
+        if pin:
+            sd = {k: streaming.pin(v) for k, v in sd.items()}
+        cls._cache.put(key, sd)
+        logger.info(f'Loaded "{os.path.basename(path)}" ({cls._cache.stats()})')
+        return sd
+
+    @classmethod
+    def clear(cls):
+        cls._cache.clear()
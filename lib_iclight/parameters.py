@@ -1,28 +1,87 @@
+import weakref
+from typing import Callable
+
 import numpy as np
+import torch
 from PIL import Image
 
-from modules.api.api import decode_base64_to_image
+from modules import sd_vae
+from modules.devices import device
 from modules.processing import (
     StableDiffusionProcessing,
     StableDiffusionProcessingImg2Img,
     StableDiffusionProcessingTxt2Img,
 )
+from modules.shared import opts
 
+from . import incremental
+from .cache import LRUCache
+from .detail_utils import DetailRestorer
+from .image_source import LazyImage
+from .incremental import Stages
 from .logging import logger
+from .matting import MATTING
 from .model_loader import ICModels
 from .rembg_utils import run_rmbg
 from .utils import (
     align_dim_latent,
+    hash_array,
     make_masked_area_grey,
     resize_and_center_crop,
 )
 
 
 class DetailTransfer:
-    def __init__(self, transfer: bool, radius: int, original: np.ndarray):
+    def __init__(self, transfer: bool, radius: int, originals: list[np.ndarray]):
         self.enable = transfer
         self.radius = radius
-        self.original = original
+        self.originals = originals
+        self.original = originals[0]
+        self._restorers: dict[int, DetailRestorer] = {}
+
+    def get_restorer(self, index: int) -> DetailRestorer:
+        """The restorer of the given batch item, shared across the batches of the job"""
+        index %= len(self.originals)
+        if index not in self._restorers:
+            self._restorers[index] = DetailRestorer(self.originals[index], self.radius)
+        return self._restorers[index]
+
+
+class ConcatLatentCache:
+    """Keeps the VAE-encoded concat conditions across batches and jobs"""
+
+    _cache = LRUCache(
+        "Concat Latent",
+        budget=lambda: int(getattr(opts, "ic_latent_cache", 0)) * 1024**2,
+        keep_last=incremental.enabled,
+    )
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return cls._cache.enabled()
+
+    @classmethod
+    def get(cls, key: tuple, vae: object) -> torch.Tensor | None:
+        entry = cls._cache.get(key)
+        if entry is None:
+            return None
+
+        vae_ref, latent = entry
+        # the id of a deleted VAE may be reused
+        if vae_ref() is not vae:
+            cls._cache.evict(lambda k: k == key)
+            return None
+
+        return latent
+
+    @classmethod
+    def put(cls, key: tuple, vae: object, latent: torch.Tensor):
+        if getattr(opts, "ic_latent_cache_offload", False):
+            latent = latent.to(device="cpu")
+        else:
+            latent = latent.to(device=device)
+
+        cls._cache.put(key, (weakref.ref(vae), latent), size=latent.nbytes)
 
 
 class ICLightArgs:
@@ -41,41 +100,101 @@ class ICLightArgs:
         detail_transfer_raw: bool,
         detail_transfer_blur_radius: int,
         reinforce_fg: bool,
+        output_target: dict | None = None,
+        matting: str = MATTING[0],
+        rembg_max_size: int = 0,
     ):
         self.model_type: str = model_type
+        self.kind: str = ICModels.get_kind(model_type)
+        self.output_target: dict | None = output_target or None
+        self._resized: dict[tuple[int, int, int], np.ndarray] = {}
+        self._concat: dict[tuple[int, int], np.ndarray] = {}
 
-        if isinstance(p, StableDiffusionProcessingImg2Img):
-            self.input_fg: np.ndarray = np.asarray(p.init_images[0], dtype=np.uint8)
-            p.init_images[0] = Image.fromarray(self.parse_image(input_fg))
-
+        is_i2i = isinstance(p, StableDiffusionProcessingImg2Img)
+        if is_i2i:
             if p.cfg_scale > 2.5:
                 logger.warning("Low CFG is recommended!")
             if p.denoising_strength < 0.9:
                 logger.warning("High Denoising Strength is recommended!")
 
+        key = None
+        self._memoized: bool = incremental.enabled()
+        if self._memoized:
+            key = incremental.fingerprint(
+                model_type,
+                p.init_images[0] if is_i2i else None,
+                input_fg,
+                uploaded_bg if self.kind == "fbc" else None,
+                remove_bg,
+                rembg_model,
+                foreground_threshold,
+                background_threshold,
+                erode_size,
+                matting,
+                rembg_max_size,
+                detail_transfer,
+                detail_transfer_raw,
+                detail_transfer_blur_radius,
+                reinforce_fg,
+            )
+            if self._restore(p, key):
+                return
+
+        # the foregrounds are decoded right away, for the background removal
+        if is_i2i:
+            self.input_fgs: list[np.ndarray] = [
+                np.asarray(p.init_images[0], dtype=np.uint8)
+            ]
+            p.init_images[0] = Image.fromarray(self.parse_image(input_fg))
+
+        elif isinstance(input_fg, (list, tuple)):
+            self.input_fgs: list[np.ndarray] = [self.parse_image(fg) for fg in input_fg]
+
         else:
-            self.input_fg: np.ndarray = self.parse_image(input_fg)
+            self.input_fgs: list[np.ndarray] = [self.parse_image(input_fg)]
 
-        self.uploaded_bg: np.ndarray = self.parse_image(uploaded_bg)
+        if isinstance(uploaded_bg, (list, tuple)):
+            assert len(uploaded_bg) == len(self.input_fgs), "Mismatched Backgrounds..."
+            bgs = [LazyImage(bg) for bg in uploaded_bg]
+        else:
+            bgs = [LazyImage(uploaded_bg)] * len(self.input_fgs)
 
-        self.input_fg_rgb: np.ndarray = self.process_input_foreground(
-            self.input_fg,
-            remove_bg,
-            rembg_model,
-            foreground_threshold,
-            background_threshold,
-            erode_size,
+        # the background is only used by fbc; decoded when the concat is built
+        self.uploaded_bgs: list[LazyImage | None] = (
+            bgs if self.kind == "fbc" else [None] * len(self.input_fgs)
         )
 
+        self.input_fgs_rgb: list[np.ndarray] = [
+            self.process_input_foreground(
+                fg,
+                remove_bg,
+                rembg_model,
+                foreground_threshold,
+                background_threshold,
+                erode_size,
+                matting,
+                rembg_max_size,
+            )
+            for fg in self.input_fgs
+        ]
+
         self.detail_transfer = DetailTransfer(
             detail_transfer,
             detail_transfer_blur_radius,
-            self.input_fg if detail_transfer_raw else self.input_fg_rgb,
+            self.input_fgs if detail_transfer_raw else self.input_fgs_rgb,
         )
 
+        if not (detail_transfer and detail_transfer_raw):
+            # the raw inputs are no longer needed once processed
+            self.input_fgs = self.input_fgs_rgb
+
+        self.input_fg: np.ndarray = self.input_fgs[0]
+        self.uploaded_bg: LazyImage | None = self.uploaded_bgs[0]
+        self.input_fg_rgb: np.ndarray = self.input_fgs_rgb[0]
+
         if detail_transfer and reinforce_fg:
             assert isinstance(p, StableDiffusionProcessingImg2Img)
-            assert self.model_type == ICModels.fc
+            assert self.kind == "fc"
 
             lightmap = np.asarray(p.init_images[0], dtype=np.uint8)
 
@@ -93,6 +212,44 @@ class ICLightArgs:
 
             p.init_images[0] = Image.fromarray(lightmap.astype(np.uint8))
 
+        if key is not None:
+            self._store(p, key)
+
+    _memo: tuple[str, dict] = None
+    """The prepared inputs of the previous job, and their fingerprint"""
+
+    _MEMO_ATTRS: tuple[str] = (
+        "input_fgs",
+        "uploaded_bgs",
+        "input_fgs_rgb",
+        "input_fg",
+        "uploaded_bg",
+        "input_fg_rgb",
+        "detail_transfer",
+        "_resized",
+        "_concat",
+    )
+
+    def _store(self, p: StableDiffusionProcessing, key: str):
+        state = {attr: getattr(self, attr) for attr in self._MEMO_ATTRS}
+        if isinstance(p, StableDiffusionProcessingImg2Img):
+            state["init_image"] = p.init_images[0]
+        ICLightArgs._memo = (key, state)
+
+    def _restore(self, p: StableDiffusionProcessing, key: str) -> bool:
+        """Reuse the prepared inputs of the previous job if the fingerprint matches"""
+        if self._memo is None or self._memo[0] != key:
+            return False
+
+        state = self._memo[1]
+        for attr in self._MEMO_ATTRS:
+            setattr(self, attr, state[attr])
+        if "init_image" in state:
+            p.init_images[0] = state["init_image"]
+
+        Stages.skipped("preprocess")
+        return True
+
     @staticmethod
     def process_input_foreground(
         image: np.ndarray,
@@ -101,6 +258,8 @@ class ICLightArgs:
         foreground_threshold: int,
         background_threshold: int,
         erode_size: int,
+        matting: str = MATTING[0],
+        rembg_max_size: int = 0,
     ) -> np.ndarray:
         """Process input foreground image into [H, W, 3] format"""
 
@@ -114,6 +273,8 @@ class ICLightArgs:
                 foreground_threshold,
                 background_threshold,
                 erode_size,
+                matting,
+                int(rembg_max_size),
             )
 
         assert len(image.shape) == 3, "Does not support greyscale image..."
@@ -126,8 +287,36 @@ class ICLightArgs:
             image[..., 3:].astype(np.float32) / 255.0,
         )
 
-    def get_concat_cond(self, p: StableDiffusionProcessing) -> np.ndarray:
-        """Returns concat condition in [B, H, W, C] format."""
+    def resize(self, image: np.ndarray, w: int, h: int) -> np.ndarray:
+        """
+        resize_and_center_crop, memoized for the job;
+        the inputs are held by this object, so their ids remain valid
+        """
+        key = (id(image), w, h)
+        if (resized := self._resized.get(key)) is None:
+            resized = self._resized[key] = resize_and_center_crop(image, w, h)
+        return resized
+
+    @property
+    def batch_size(self) -> int:
+        """Number of foregrounds relit together in one batch"""
+        return len(self.input_fgs)
+
+    @property
+    def input_hash(self) -> str:
+        """Content hash of the inputs that make up the concat condition"""
+        if getattr(self, "_input_hash", None) is None:
+            self._input_hash = "".join(hash_array(fg) for fg in self.input_fgs_rgb)
+            if self.kind == "fbc":
+                self._input_hash += "".join(
+                    hash_array(bg.image) for bg in self.uploaded_bgs
+                )
+
+        return self._input_hash
+
+    @staticmethod
+    def get_target_size(p: StableDiffusionProcessing) -> tuple[int, int]:
+        """Returns the (width, height) of the current sampling pass"""
 
         if getattr(p, "is_hr_pass", False):
             assert isinstance(p, StableDiffusionProcessingTxt2Img)
@@ -143,30 +332,104 @@ class ICLightArgs:
             image_width = p.width
             image_height = p.height
 
-        fg = resize_and_center_crop(self.input_fg_rgb, image_width, image_height)
+        return image_width, image_height
 
-        match self.model_type:
-            case ICModels.fc:
-                np_concat = [fg]
-            case ICModels.fbc:
-                bg = resize_and_center_crop(
-                    self.uploaded_bg,
-                    image_width,
-                    image_height,
-                )
-                np_concat = [fg, bg]
-            case _:
-                raise ValueError
+    def get_concat_cond(self, p: StableDiffusionProcessing) -> np.ndarray:
+        """
+        Returns concat condition in [B, H, W, C] format,
+        where each batch item contributes its foreground (and background) in order
+        """
+
+        image_width, image_height = self.get_target_size(p)
+        if (concat := self._concat.get((image_width, image_height))) is not None:
+            Stages.skipped("concat")
+            return concat
+
+        np_concat = []
+
+        for input_fg_rgb, uploaded_bg in zip(self.input_fgs_rgb, self.uploaded_bgs):
+            fg = self.resize(input_fg_rgb, image_width, image_height)
+
+            match self.kind:
+                case "fc":
+                    np_concat += [fg]
+                case "fbc":
+                    bg = self.resize(uploaded_bg.image, image_width, image_height)
+                    np_concat += [fg, bg]
+                case _:
+                    raise ValueError
+
+        concat = self._concat[(image_width, image_height)] = np.stack(np_concat)
+        if self.is_last_pass(p):
+            self._free_inputs()
+        return concat
+
+    @staticmethod
+    def is_last_pass(p: StableDiffusionProcessing) -> bool:
+        """Whether no other sampling pass (ie. Hires. Fix) follows the current one"""
+        return not getattr(p, "enable_hr", False) or getattr(p, "is_hr_pass", False)
+
+    def _free_inputs(self):
+        """
+        Free the decoded backgrounds and the resized copies once the last concat
+        is built, unless they are kept by the memo for the next job;
+        `input_hash` is taken before, by `get_concat_latent`, if it is needed
+        """
+        if self._memoized:
+            return
+
+        for bg in self.uploaded_bgs:
+            if bg is not None:
+                bg.release()
+        self._resized = {}
+
+    def get_concat_latent(
+        self,
+        p: StableDiffusionProcessing,
+        encode: Callable[[np.ndarray], torch.Tensor],
+        vae: object,
+    ) -> torch.Tensor:
+        """
+        Returns the concat condition encoded by `encode`,
+        reusing the cached latent if the inputs, resolution and VAE are unchanged
+        """
+
+        if not ConcatLatentCache.enabled():
+            # nothing to look up; skip hashing the inputs
+            return encode(self.get_concat_cond(p))
+
+        key = (
+            self.input_hash,
+            *self.get_target_size(p),
+            self.model_type,
+            id(vae),
+            getattr(sd_vae, "loaded_vae_file", None),
+        )
+
+        if (latent := ConcatLatentCache.get(key, vae)) is not None:
+            logger.debug("Reusing the encoded concat condition")
+            Stages.skipped("encode")
+            return latent
+
+        latent = encode(self.get_concat_cond(p))
+        ConcatLatentCache.put(key, vae, latent)
+        return latent
 
-        return np.stack(np_concat, axis=0)
+    def release(self):
+        """
+        Drop the references to the decoded inputs and the resized copies
+        once the job is done; they may still be held by the memo
+        """
+        self._resized, self._concat = {}, {}
+        self.input_fgs = self.input_fgs_rgb = self.uploaded_bgs = []
+        self.input_fg = self.input_fg_rgb = self.uploaded_bg = None
+        self.detail_transfer = None
 
     @staticmethod
     def decode_base64(base64string: str) -> np.ndarray:
-        return np.asarray(decode_base64_to_image(base64string), dtype=np.uint8)
+        return LazyImage.decode(base64string)
 
     @staticmethod
     def parse_image(value) -> np.ndarray:
-        if isinstance(value, str):
-            return ICLightArgs.decode_base64(value)
-        assert isinstance(value, np.ndarray) or (value is None)
-        return value
+        """Decode any of the sources accepted by LazyImage"""
+        return LazyImage(value).image
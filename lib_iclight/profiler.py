@@ -0,0 +1,182 @@
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Iterator
+
+import numpy as np
+import torch
+
+from modules.shared import opts
+
+from .logging import logger
+
+HISTORY: int = 256
+"""Number of jobs kept for the aggregates"""
+
+
+_frames: list[list[int]] = []
+"""The peak VRAM seen by each open `cuda_peak` block, before the nested resets"""
+
+
+@contextmanager
+def cuda_peak() -> Iterator[dict[str, float]]:
+    """
+    Peak VRAM allocated within the block, in MB above the allocation at its start;
+    set as "peak" in the yielded dict on exit
+
+    The only place the global peak stats are reset; the enclosing blocks keep
+    the peak seen before each reset, so that nested blocks do not clobber them
+    """
+    result = {"peak": 0.0}
+    if not torch.cuda.is_available():
+        yield result
+        return
+
+    torch.cuda.synchronize()
+    current = torch.cuda.max_memory_allocated()
+    for frame in _frames:
+        frame[0] = max(frame[0], current)
+
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    frame = [base]
+    _frames.append(frame)
+
+    try:
+        yield result
+    finally:
+        torch.cuda.synchronize()
+        _frames.remove(frame)
+        peak = max(frame[0], torch.cuda.max_memory_allocated())
+        result["peak"] = (peak - base) / 1024**2
+
+
+class Profiler:
+    """
+    Records the wall time, CPU time and peak memory of each stage of a job;
+    the host peak only covers the Python heap (tracemalloc),
+    not the native allocations of torch or onnxruntime
+    """
+
+    _job: dict[str, dict[str, float]] = None
+    _history: deque[dict[str, dict[str, float]]] = deque(maxlen=HISTORY)
+    _host_frames: list[list[int]] = []
+
+    @staticmethod
+    def enabled() -> bool:
+        return getattr(opts, "ic_profile", False)
+
+    @classmethod
+    def begin_job(cls):
+        cls._job = {} if cls.enabled() else None
+
+    @classmethod
+    def end_job(cls):
+        if cls._job is None:
+            return
+
+        job, cls._job = cls._job, None
+        if not job:
+            return
+
+        cls._history.append(job)
+        logger.info(cls.format(job))
+
+    @classmethod
+    def stage(cls, name: str) -> ContextManager:
+        """Measure the block as a stage of the current job; does nothing when disabled"""
+        if cls._job is None:
+            return nullcontext()
+        return cls._measure(name)
+
+    @classmethod
+    @contextmanager
+    def _measure(cls, name: str) -> Iterator[None]:
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # keep the peak of the enclosing stages before resetting it
+            current = tracemalloc.get_traced_memory()[1]
+            for frame in cls._host_frames:
+                frame[0] = max(frame[0], current)
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        host_base = tracemalloc.get_traced_memory()[0]
+        host_frame = [host_base]
+        cls._host_frames.append(host_frame)
+
+        wall, cpu = time.perf_counter(), time.process_time()
+
+        try:
+            with cuda_peak() as vram:
+                # after the pending GPU work is synchronized
+                wall, cpu = time.perf_counter(), time.process_time()
+                yield
+        finally:
+            record = {
+                "wall": time.perf_counter() - wall,
+                "cpu": time.process_time() - cpu,
+                "host_peak": (
+                    max(host_frame[0], tracemalloc.get_traced_memory()[1]) - host_base
+                )
+                / 1024**2,
+                "cuda_peak": vram["peak"],
+            }
+
+            cls._host_frames.remove(host_frame)
+            if not tracing:
+                tracemalloc.stop()
+
+            cls.record(name, record)
+
+    @classmethod
+    def record(cls, name: str, record: dict[str, float]):
+        """Add a stage measured elsewhere (eg. within the backend) to the current job"""
+        if cls._job is not None:
+            cls._accumulate(cls._job.setdefault(name, {}), record)
+
+    @staticmethod
+    def _accumulate(total: dict[str, float], record: dict[str, float]):
+        """A stage may run more than once per job (eg. Hires. Fix)"""
+        for key, value in record.items():
+            if key.endswith("peak"):
+                total[key] = max(total.get(key, 0.0), value)
+            else:
+                total[key] = total.get(key, 0.0) + value
+
+    @classmethod
+    def summary(cls) -> dict[str, dict[str, float]]:
+        """p50 / p95 of every metric of every stage, over the recent jobs"""
+        values: dict[str, dict[str, list[float]]] = {}
+        for job in cls._history:
+            for stage, record in job.items():
+                for key, value in record.items():
+                    values.setdefault(stage, {}).setdefault(key, []).append(value)
+
+        summary = {}
+        for stage, metrics in values.items():
+            summary[stage] = {"count": len(next(iter(metrics.values())))}
+            for key, samples in metrics.items():
+                p50, p95 = np.percentile(samples, (50, 95))
+                summary[stage][f"{key}_p50"] = round(float(p50), 4)
+                summary[stage][f"{key}_p95"] = round(float(p95), 4)
+
+        return summary
+
+    @classmethod
+    def format(cls, job: dict[str, dict[str, float]]) -> str:
+        summary = cls.summary()
+        stages = []
+        for stage, record in job.items():
+            stats = summary.get(stage, {})
+            stages.append(
+                f"{stage}: {record['wall']:.3f}s "
+                f"(cpu {record['cpu']:.3f}s, "
+                f"py heap +{record['host_peak']:.0f}MB, "
+                f"cuda +{record['cuda_peak']:.0f}MB; "
+                f"p50 {stats.get('wall_p50', 0.0):.3f}s, "
+                f"p95 {stats.get('wall_p95', 0.0):.3f}s)"
+            )
+
+        return "Profile - " + " | ".join(stages)
@@ -3,7 +3,15 @@
 # https://github.com/AUTOMATIC1111/stable-diffusion-webui-rembg #
 # ============================================================= #
 
+import hashlib
+import inspect
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator
 
 import numpy as np
 import rembg
@@ -12,6 +20,13 @@ from PIL import Image
 from modules.paths import models_path
 from modules.shared import opts
 
+from . import incremental
+from .cache import LRUCache
+from .incremental import Stages
+from .logging import logger
+from .matting import MATTING, refine_alpha, upsample_mask
+from .utils import hash_array, make_masked_area_grey
+
 if "U2NET_HOME" not in os.environ:
     os.environ["U2NET_HOME"] = os.path.join(models_path, "u2net")
 
@@ -34,28 +49,517 @@ def get_models() -> tuple[str]:
         )
 
 
-def run_rmbg(
+def get_providers() -> tuple[str]:
+    """
+    The execution providers from the Settings, in order of preference,
+    that are available in the installed onnxruntime; CPU is always the last resort
+    """
+    import onnxruntime as ort
+
+    available = ort.get_available_providers()
+    preferred = getattr(opts, "ic_rembg_providers", "CPUExecutionProvider")
+
+    providers = []
+    for name in str(preferred).split(","):
+        name = name.strip()
+        if name and not name.endswith("ExecutionProvider"):
+            name += "ExecutionProvider"
+        if name in available and name not in providers:
+            providers.append(name)
+        elif name:
+            logger.debug(f'Execution Provider "{name}" is not available')
+
+    if "CPUExecutionProvider" not in providers:
+        providers.append("CPUExecutionProvider")
+
+    return tuple(providers)
+
+
+def get_threads() -> tuple[int, int]:
+    """(intra-op, inter-op) threads of the CPU provider; 0 = onnxruntime default"""
+    return (
+        int(getattr(opts, "ic_rembg_intra_threads", 0)),
+        int(getattr(opts, "ic_rembg_inter_threads", 0)),
+    )
+
+
+def _takes_providers(session_class: type) -> bool:
+    """Whether the session of the installed rembg accepts the providers"""
+    return "providers" in inspect.signature(session_class.__init__).parameters
+
+
+def _rembg_providers() -> list[str]:
+    """The providers rembg (up to 2.0.65) picks on its own"""
+    import onnxruntime as ort
+
+    if ort.get_device() == "GPU":
+        if "CUDAExecutionProvider" in ort.get_available_providers():
+            return ["CUDAExecutionProvider", "CPUExecutionProvider"]
+    return ["CPUExecutionProvider"]
+
+
+def new_session(
+    model: str, providers: tuple[str], threads: tuple[int, int], **kwargs
+) -> "rembg.sessions.BaseSession":
+    """
+    rembg.new_session, but with the given providers and threads;
+    rembg up to 2.0.65 has no providers argument and picks CUDA on its own
+    """
+    import onnxruntime as ort
+    from rembg.sessions import sessions_class
+    from rembg.sessions.base import BaseSession
+    from rembg.sessions.u2net import U2netSession
+
+    session_class = next((sc for sc in sessions_class if sc.name() == model), None)
+    session_class = session_class or U2netSession
+
+    sess_opts = ort.SessionOptions()
+    intra, inter = threads
+    if intra > 0:
+        sess_opts.intra_op_num_threads = intra
+    if inter > 0:
+        sess_opts.inter_op_num_threads = inter
+
+    if _takes_providers(session_class):
+        return session_class(model, sess_opts, providers=list(providers), **kwargs)
+
+    if (
+        list(providers) == _rembg_providers()
+        or session_class.__init__ is not BaseSession.__init__
+    ):
+        # the custom sessions (eg. sam) keep the rembg default providers
+        return session_class(model, sess_opts, **kwargs)
+
+    # same as BaseSession.__init__, with the providers of the Settings
+    session = session_class.__new__(session_class)
+    session.model_name = model
+    session.inner_session = ort.InferenceSession(
+        str(session_class.download_models(**kwargs)),
+        sess_options=sess_opts,
+        providers=list(providers),
+    )
+    return session
+
+
+class SessionPool:
+    """
+    Process-wide pool of rembg sessions,
+    keyed by model, execution providers and thread counts
+    """
+
+    _lock = threading.Lock()
+    _idle: dict[tuple, list[tuple[object, float]]] = {}
+    _timer: threading.Timer = None
+
+    @staticmethod
+    def _key(model: str) -> tuple[str, tuple[str], tuple[int, int]]:
+        return (model, get_providers(), get_threads())
+
+    @staticmethod
+    def _timeout() -> float:
+        return float(getattr(opts, "ic_rembg_idle_timeout", 600))
+
+    @classmethod
+    @contextmanager
+    def checkout(cls, model: str) -> Iterator["rembg.sessions.BaseSession"]:
+        """
+        Borrow a session exclusively; concurrent requests for the same model
+        each get their own session instead of waiting on one
+        """
+        key = cls._key(model)
+
+        with cls._lock:
+            cls._evict_idle()
+            idle = cls._idle.get(key)
+            session = idle.pop()[0] if idle else None
+
+        if session is None:
+            session = new_session(*key)
+            logger.debug(
+                f'Created rembg session for "{model}" '
+                f"({', '.join(session.inner_session.get_providers())})"
+            )
+
+        try:
+            yield session
+        finally:
+            with cls._lock:
+                cls._idle.setdefault(key, []).append((session, time.monotonic()))
+                cls._schedule()
+
+    @classmethod
+    def add(cls, model: str, session: "rembg.sessions.BaseSession"):
+        """Add an externally created session (eg. of a custom model) to the pool"""
+        with cls._lock:
+            cls._idle.setdefault(cls._key(model), []).append(
+                (session, time.monotonic())
+            )
+            cls._schedule()
+
+    @classmethod
+    def _evict_idle(cls):
+        """Drop the sessions idle for longer than the timeout (requires the lock)"""
+        if (timeout := cls._timeout()) <= 0:
+            return
+
+        deadline = time.monotonic() - timeout
+        for key, idle in list(cls._idle.items()):
+            idle[:] = [(s, t) for s, t in idle if t > deadline]
+            if not idle:
+                del cls._idle[key]
+
+    @classmethod
+    def _schedule(cls):
+        """
+        Evict once the oldest idle session times out (requires the lock);
+        so that the sessions are freed even if no other job comes
+        """
+        if cls._timer is not None or not cls._idle or (timeout := cls._timeout()) <= 0:
+            return
+
+        oldest = min(t for idle in cls._idle.values() for _, t in idle)
+        delay = max(oldest + timeout - time.monotonic(), 0.0) + 1.0
+        cls._timer = threading.Timer(delay, cls._on_timer)
+        cls._timer.name = "ic-light-rembg-evict"
+        cls._timer.daemon = True
+        cls._timer.start()
+
+    @classmethod
+    def _on_timer(cls):
+        with cls._lock:
+            cls._timer = None
+            cls._evict_idle()
+            cls._schedule()
+
+    @classmethod
+    def warmup(cls, models: tuple[str]):
+        """Create one session per model in a background thread"""
+
+        def _warmup():
+            for model in models:
+                try:
+                    with cls.checkout(model):
+                        pass
+                except Exception as e:
+                    logger.warning(f'Failed to warm up rembg model "{model}": {e}')
+
+        threading.Thread(
+            target=_warmup, name="ic-light-rembg-warmup", daemon=True
+        ).start()
+
+
+def normalize_params(
+    model: str,
+    foreground_threshold: int,
+    background_threshold: int,
+    erode_size: int,
+    matting: str = MATTING[0],
+    max_size: int = 0,
+) -> tuple[str, int, int, int, str, int]:
+    """
+    The Background Removal parameters with their canonical types
+    (eg. Gradio and the API may send 1024.0 for 1024);
+    so that the prefetch and the job compute the same key
+    """
+    return (
+        str(model),
+        int(foreground_threshold),
+        int(background_threshold),
+        int(erode_size),
+        str(matting),
+        int(max_size),
+    )
+
+
+class RembgCache:
+    """
+    Content-addressed cache of the Background Removal results,
+    kept in memory and optionally written through to disk
+    """
+
+    _memory = LRUCache(
+        "Background Removal",
+        budget=lambda: int(getattr(opts, "ic_rembg_cache", 0)) * 1024**2,
+        keep_last=incremental.enabled,
+    )
+    folder: str = os.path.join(models_path, "ic-light", "cache")
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return cls._memory.enabled() or getattr(opts, "ic_rembg_cache_disk", False)
+
+    @staticmethod
+    def key(np_image: np.ndarray, *params) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(hash_array(np_image).encode())
+        h.update(repr(params).encode())
+        return h.hexdigest()
+
+    @classmethod
+    def _file(cls, key: str) -> str:
+        return os.path.join(cls.folder, f"{key}.npz")
+
+    @classmethod
+    def get(cls, key: str) -> tuple[np.ndarray, np.ndarray] | None:
+        if (result := cls._memory.get(key)) is not None:
+            return result
+
+        if not getattr(opts, "ic_rembg_cache_disk", False):
+            return None
+        if not os.path.isfile(path := cls._file(key)):
+            return None
+
+        try:
+            with np.load(path) as data:
+                result = cls._freeze(data["rgb"], data["mask"])
+            # the least recently used files are deleted first
+            os.utime(path)
+        except Exception as e:
+            logger.warning(f'Failed to read cached "{path}": {e}')
+            return None
+
+        cls._memory.put(key, result)
+        return result
+
+    @classmethod
+    def put(cls, key: str, rgb: np.ndarray, mask: np.ndarray):
+        result = cls._freeze(rgb, mask)
+        cls._memory.put(key, result)
+
+        if not getattr(opts, "ic_rembg_cache_disk", False):
+            return
+
+        try:
+            os.makedirs(cls.folder, exist_ok=True)
+            np.savez_compressed(cls._file(key), rgb=rgb, mask=mask)
+            cls._trim_disk()
+        except OSError as e:
+            logger.warning(f"Failed to write Background Removal cache: {e}")
+
+    @classmethod
+    def _trim_disk(cls):
+        """Delete the least recently used files beyond the disk budget"""
+        budget = int(getattr(opts, "ic_rembg_cache_disk_budget", 1024)) * 1024**2
+
+        files = []
+        for entry in os.scandir(cls.folder):
+            if entry.is_file() and entry.name.endswith(".npz"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(f[1] for f in files)
+        for _, file_size, path in sorted(files):
+            if size <= budget:
+                break
+            os.remove(path)
+            size -= file_size
+
+    @staticmethod
+    def _freeze(*arrays: np.ndarray) -> tuple[np.ndarray]:
+        """The cached results are shared between jobs, thus must not be modified"""
+        for arr in arrays:
+            arr.flags.writeable = False
+        return arrays
+
+
+class RembgPrefetch:
+    """
+    Runs the Background Removal of upcoming jobs on a thread pool,
+    so that it overlaps the sampling of the current job;
+    the results are held until taken by the job
+    """
+
+    MAX_PENDING: int = 16
+    """Oldest results are dropped past this many untaken prefetches"""
+
+    _lock = threading.Lock()
+    _pool: ThreadPoolExecutor = None
+    _pool_size: int = 0
+    _futures: OrderedDict[str, Future] = OrderedDict()
+
+    @staticmethod
+    def workers() -> int:
+        return int(getattr(opts, "ic_rembg_prefetch", 0))
+
+    @classmethod
+    def _executor(cls) -> ThreadPoolExecutor:
+        """(Re)create the pool if the number of workers changed (requires the lock)"""
+        if cls._pool is None or cls._pool_size != cls.workers():
+            if cls._pool is not None:
+                cls._pool.shutdown(wait=False)
+            cls._pool_size = cls.workers()
+            cls._pool = ThreadPoolExecutor(
+                cls._pool_size, thread_name_prefix="ic-light-rembg"
+            )
+        return cls._pool
+
+    @classmethod
+    def submit(
+        cls,
+        np_image: np.ndarray,
+        model: str,
+        foreground_threshold: int,
+        background_threshold: int,
+        erode_size: int,
+        matting: str = MATTING[0],
+        max_size: int = 0,
+    ):
+        """Start removing the background; does nothing when disabled"""
+        if cls.workers() <= 0 or np_image is None:
+            return
+
+        params = normalize_params(
+            model,
+            foreground_threshold,
+            background_threshold,
+            erode_size,
+            matting,
+            max_size,
+        )
+        key = RembgCache.key(np_image, *params)
+        if RembgCache.get(key) is not None:
+            return
+
+        with cls._lock:
+            if key in cls._futures:
+                return
+
+            while len(cls._futures) >= cls.MAX_PENDING:
+                cls._futures.popitem(last=False)[1].cancel()
+
+            cls._futures[key] = cls._executor().submit(
+                _remove_background, np_image, key, *params
+            )
+
+        logger.debug("Prefetching Background Removal")
+
+    @classmethod
+    def take(cls, key: str) -> tuple[np.ndarray, np.ndarray] | None:
+        """Wait for the prefetched result; None if not prefetched or failed"""
+        with cls._lock:
+            future = cls._futures.pop(key, None)
+
+        if future is None or future.cancelled():
+            return None
+
+        try:
+            return future.result()
+        except Exception as e:
+            logger.warning(f"Prefetched Background Removal failed: {e}")
+            return None
+
+
+def remove_background(
     np_image: np.ndarray,
     model: str,
     foreground_threshold: int,
     background_threshold: int,
     erode_size: int,
-) -> np.ndarray:
+    matting: str = MATTING[0],
+    max_size: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the subject composited onto grey [H, W, 3], and its mask [H, W];
+    with max_size, the segmentation runs with the longest side capped at max_size,
+    and the mask is upsampled to the original resolution
+    """
+    params = normalize_params(
+        model,
+        foreground_threshold,
+        background_threshold,
+        erode_size,
+        matting,
+        max_size,
+    )
+    if not (RembgCache.enabled() or RembgPrefetch.workers() > 0):
+        # nothing to look up; skip hashing the image
+        return _remove_background(np_image, None, *params)
+
+    key = RembgCache.key(np_image, *params)
+
+    if (result := RembgCache.get(key)) is not None:
+        logger.debug(f"Background Removal cache hit ({RembgCache._memory.stats()})")
+        Stages.skipped("rembg")
+        return result
+
+    if (result := RembgPrefetch.take(key)) is not None:
+        logger.debug("Using the prefetched Background Removal")
+        return result
+
+    return _remove_background(np_image, key, *params)
+
+
+def _remove_background(
+    np_image: np.ndarray,
+    key: str | None,
+    model: str,
+    foreground_threshold: int,
+    background_threshold: int,
+    erode_size: int,
+    matting: str = MATTING[0],
+    max_size: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
     image = Image.fromarray(np_image.astype(np.uint8)).convert("RGB")
+    w, h = image.size
+
+    capped = max_size > 0 and max(w, h) > max_size
+    if capped:
+        ratio = max_size / max(w, h)
+        size = (max(1, round(w * ratio)), max(1, round(h * ratio)))
+        segment = image.resize(size, Image.Resampling.BOX)
+    else:
+        segment = image
+
+    with SessionPool.checkout(model) as session:
+        processed_image: Image.Image = rembg.remove(
+            segment,
+            session=session,
+            alpha_matting=(matting == "pymatting"),
+            alpha_matting_foreground_threshold=foreground_threshold,
+            alpha_matting_background_threshold=background_threshold,
+            alpha_matting_erode_size=erode_size,
+            post_process_mask=True,
+            only_mask=(matting != "pymatting"),
+        )
+
+    if matting == "pymatting" and not capped:
+        rgba = np.asarray(processed_image.convert("RGBA"), dtype=np.uint8)
+        rgb, mask = rgba[..., :3], np.ascontiguousarray(rgba[..., 3])
+    else:
+        # the estimated foreground colors of pymatting are only used at full size
+        rgb = np.asarray(image, dtype=np.uint8)
+        mask = np.asarray(
+            processed_image.getchannel("A" if matting == "pymatting" else 0)
+        )
+        mask = upsample_mask(np.ascontiguousarray(mask, dtype=np.uint8), w, h)
+
+    if matting == "guided filter":
+        mask = refine_alpha(
+            rgb, mask, foreground_threshold, background_threshold, erode_size
+        )
+
+    rgb = make_masked_area_grey(rgb, mask[..., None] / 255.0)
+
+    if key is not None:
+        RembgCache.put(key, rgb, mask)
+    return rgb, mask
 
-    processed_image = rembg.remove(
-        image,
-        session=rembg.new_session(
-            model_name=model,
-            providers=["CPUExecutionProvider"],
-        ),
-        alpha_matting=True,
-        alpha_matting_foreground_threshold=foreground_threshold,
-        alpha_matting_background_threshold=background_threshold,
-        alpha_matting_erode_size=erode_size,
-        post_process_mask=True,
-        only_mask=False,
-        bgcolor=(127, 127, 127, 255),
-    )
 
-    return np.asarray(processed_image.convert("RGB"), dtype=np.uint8)
+def run_rmbg(
+    np_image: np.ndarray,
+    model: str,
+    foreground_threshold: int,
+    background_threshold: int,
+    erode_size: int,
+    matting: str = MATTING[0],
+    max_size: int = 0,
+) -> np.ndarray:
+    return remove_background(
+        np_image,
+        model,
+        foreground_threshold,
+        background_threshold,
+        erode_size,
+        matting,
+        max_size,
+    )[0]
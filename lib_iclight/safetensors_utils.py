@@ -0,0 +1,68 @@
+import json
+import os
+import struct
+
+import torch
+
+DTYPES: dict[str, torch.dtype] = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "F8_E4M3": torch.float8_e4m3fn,
+    "F8_E5M2": torch.float8_e5m2,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+MAX_HEADER: int = 100 * 1024**2
+
+
+def read_header(path: str) -> tuple[dict[str, dict], dict[str, str], int]:
+    """
+    Returns the tensor entries (dtype, shape, data_offsets) and the metadata,
+    along with the offset of the data; only the header is read from the file
+    """
+    with open(path, "rb") as file:
+        prefix = file.read(8)
+        if len(prefix) < 8 or (length := struct.unpack("<Q", prefix)[0]) > MAX_HEADER:
+            raise ValueError(f'Invalid safetensors header in "{path}"')
+        header: dict = json.loads(file.read(length))
+
+    metadata = header.pop("__metadata__", None) or {}
+    return header, metadata, 8 + length
+
+
+def mmap_load(path: str) -> dict[str, torch.Tensor]:
+    """
+    CPU tensors backed by a private memory-map of the file, instead of a copy;
+    the pages are read on first access, and the page cache is shared by
+    every process mapping the same file (until written to, which copies the page)
+    """
+    header, _, start = read_header(path)
+    storage = torch.UntypedStorage.from_file(
+        path, shared=False, nbytes=os.path.getsize(path)
+    )
+
+    sd = {}
+    for key, entry in header.items():
+        dtype = DTYPES[entry["dtype"]]
+        begin, end = entry["data_offsets"]
+        offset = start + begin
+        size = dtype.itemsize
+
+        if offset % size == 0:
+            tensor = torch.empty(0, dtype=dtype)
+            sd[key] = tensor.set_(storage, offset // size, entry["shape"])
+        else:
+            # the data of a tensor is only aligned to its dtype by convention
+            raw = torch.empty(0, dtype=torch.uint8).set_(
+                storage, offset, (end - begin,)
+            )
+            sd[key] = raw.clone().view(dtype).reshape(entry["shape"])
+
+    return sd
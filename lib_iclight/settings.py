@@ -1,3 +1,5 @@
+import gradio as gr
+
 from modules.shared import OptionInfo, opts
 
 
@@ -13,3 +15,212 @@ def ic_settings():
         "ic_all_rembg",
         OptionInfo(False, "List all available Rembg models", **args).needs_reload_ui(),
     )
+
+    opts.add_option(
+        "ic_incremental",
+        OptionInfo(
+            False,
+            "Reuse the results of the previous generation for the unchanged inputs",
+            **args,
+        ).info(
+            "skips the preprocessing, encoding, model loading and patching "
+            "when only the prompts or seeds change; keeps the latest results in memory"
+        ),
+    )
+
+    opts.add_option(
+        "ic_model_cache",
+        OptionInfo(
+            0,
+            "Memory budget for caching the IC-Light models across generations (MB)",
+            **args,
+        ).info(
+            "0 = disabled; the models are kept in the checkpoint's dtype and device"
+        ),
+    )
+
+    opts.add_option(
+        "ic_unet_cache",
+        OptionInfo(
+            False,
+            "Keep the IC-Light patched UNet resident between generations",
+            **args,
+        ).info(
+            "Forge only; consecutive jobs on the same checkpoint skip weight patching"
+        ),
+    )
+
+    opts.add_option(
+        "ic_stream_patch",
+        OptionInfo(
+            0,
+            "Stream the IC-Light weights to the GPU during patching, within (MB)",
+            **args,
+        ).info(
+            "Forge only; 0 = disabled; keeps the weights in pinned host memory, "
+            "instead of a whole extra UNet in VRAM"
+        ),
+    )
+
+    opts.add_option(
+        "ic_rembg_idle_timeout",
+        OptionInfo(
+            600,
+            "Release the idle Background Removal sessions after (seconds)",
+            **args,
+        ).info("0 = never"),
+    )
+
+    opts.add_option(
+        "ic_rembg_warmup",
+        OptionInfo(
+            False,
+            "Load the Background Removal models on startup",
+            **args,
+        ).needs_restart(),
+    )
+
+    opts.add_option(
+        "ic_rembg_providers",
+        OptionInfo(
+            "CPUExecutionProvider",
+            "Execution Providers for Background Removal, in order of preference",
+            **args,
+        ).info(
+            'comma separated; eg. "Tensorrt, CUDA, OpenVINO, CPU"; '
+            "unavailable ones are skipped, and CPU is always the fallback"
+        ),
+    )
+
+    opts.add_option(
+        "ic_rembg_intra_threads",
+        OptionInfo(
+            0,
+            "Threads used within each Background Removal operator (CPU)",
+            **args,
+        ).info("0 = onnxruntime default, ie. all cores"),
+    )
+
+    opts.add_option(
+        "ic_rembg_inter_threads",
+        OptionInfo(
+            0,
+            "Threads used across Background Removal operators (CPU)",
+            **args,
+        ).info("0 = onnxruntime default"),
+    )
+
+    opts.add_option(
+        "ic_rembg_prefetch",
+        OptionInfo(
+            0,
+            "Number of threads removing the backgrounds ahead of the generation",
+            **args,
+        ).info("0 = disabled; starts on upload, and for the queued relight API jobs"),
+    )
+
+    opts.add_option(
+        "ic_rembg_cache",
+        OptionInfo(
+            0,
+            "Memory budget for caching the Background Removal results (MB)",
+            **args,
+        ).info("0 = disabled"),
+    )
+
+    opts.add_option(
+        "ic_rembg_cache_disk",
+        OptionInfo(
+            False,
+            'Also store the Background Removal results in "models/ic-light/cache"',
+            **args,
+        ),
+    )
+
+    opts.add_option(
+        "ic_rembg_cache_disk_budget",
+        OptionInfo(
+            1024,
+            'Disk budget of "models/ic-light/cache" (MB)',
+            **args,
+        ).info("the oldest results are deleted first"),
+    )
+
+    opts.add_option(
+        "ic_latent_cache",
+        OptionInfo(
+            0,
+            "Memory budget for caching the encoded concat conditions (MB)",
+            **args,
+        ).info("0 = disabled"),
+    )
+
+    opts.add_option(
+        "ic_latent_cache_offload",
+        OptionInfo(False, "Keep the cached concat conditions on CPU", **args),
+    )
+
+    opts.add_option(
+        "ic_tiled_vae",
+        OptionInfo(
+            0.0,
+            "Encode the concat conditions in tiles above this many pixels (Megapixels)",
+            **args,
+        ).info("0 = disabled; fbc counts both the foreground and the background"),
+    )
+
+    opts.add_option(
+        "ic_profile",
+        OptionInfo(
+            False,
+            "Log the time and memory spent in each stage of IC-Light",
+            **args,
+        ).info("also served at /ic-light/v1/stats; adds some overhead when enabled"),
+    )
+
+    opts.add_option(
+        "ic_split_conv_in",
+        OptionInfo(
+            False,
+            "Compute the contribution of the concat conditioning to conv_in once per job",
+            **args,
+        ).info(
+            "instead of concatenating it onto the latent at every step; "
+            "keeps the original input channels of the UNet"
+        ),
+    )
+
+    opts.add_option(
+        "ic_detail_gpu",
+        OptionInfo(
+            False,
+            "Restore Details on the GPU, directly from the decoded batch",
+            **args,
+        ).info(
+            "runs before Face Restoration and Color Correction, from the unquantized "
+            "images, so the output differs from the CPU path by up to 2 levels; "
+            "the decoded batch is copied to the GPU and back"
+        ),
+    )
+
+    opts.add_option(
+        "ic_resize_backend",
+        OptionInfo(
+            "PIL",
+            "Backend for resizing the inputs",
+            gr.Radio,
+            {"choices": ("PIL", "OpenCV", "torch")},
+            **args,
+        ).info(
+            "PIL = Lanczos, within ±1 of resizing the whole image; OpenCV / torch = faster"
+        ),
+    )
+
+    opts.add_option(
+        "ic_local_inputs",
+        OptionInfo(
+            False,
+            "Allow the API to exchange images through local files and shared memory",
+            **args,
+        ).info("only enable this if the API is not exposed to untrusted clients"),
+    )
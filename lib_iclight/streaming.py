@@ -0,0 +1,279 @@
+"""
+Layer-streamed weight patching
+
+The IC-Light weights stay in (pinned) host memory, and are copied to the device
+on a side stream ahead of the backend's merge, within a window of VRAM;
+so that patching needs about one window of extra VRAM, instead of a whole UNet
+"""
+
+import importlib
+import time
+import weakref
+from functools import wraps
+from typing import Callable
+
+import torch
+
+from modules.shared import opts
+
+from .cache import nbytes
+from .compressed import LowRank
+from .logging import logger
+from .profiler import Profiler, cuda_peak
+
+MERGE_FUNCTIONS: tuple[tuple[str, str, str | None], ...] = (
+    ("backend.patcher.lora", "merge_lora_to_weight", None),
+    ("ldm_patched.modules.lora", "calculate_weight", None),
+    ("ldm_patched.modules.model_patcher", "calculate_weight", "ModelPatcher"),
+)
+"""(module, function, class) computing the patched weight of a layer"""
+
+PASS_FUNCTIONS: tuple[tuple[str, str, str | None], ...] = (
+    ("backend.patcher.lora", "refresh", "LoraLoader"),
+    ("ldm_patched.modules.model_patcher", "patch_model", "ModelPatcher"),
+)
+"""(module, function, class) merging every patch of a model; ie. a pass"""
+
+
+def window() -> int:
+    """The VRAM window in bytes; 0 = disabled"""
+    return int(getattr(opts, "ic_stream_patch", 0)) * 1024**2
+
+
+def enabled() -> bool:
+    return window() > 0
+
+
+def pin(value: torch.Tensor | LowRank) -> torch.Tensor | LowRank:
+    """Page-locked copy of the host tensor, for asynchronous copies to the GPU"""
+    if not torch.cuda.is_available():
+        return value
+    if isinstance(value, LowRank):
+        return LowRank(value.up.pin_memory(), value.down.pin_memory(), value.shape)
+    return value.pin_memory()
+
+
+def _locate(candidates: tuple[tuple[str, str, str | None], ...]):
+    """The first (owner, name, function) of the candidates present in the backend"""
+    for module_name, name, owner in candidates:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+
+        target = getattr(module, owner, None) if owner else module
+        if (func := getattr(target, name, None)) is not None:
+            return target, name, func
+
+    return None
+
+
+class PatchStream:
+    """
+    Copies the patches of one patched model to the device ahead of the merge,
+    in order, keeping at most `window` bytes in flight
+
+    The patches are registered by their own tuple, which the backend keeps
+    as is; so every patched model streams its own patches,
+    even when they share the same (cached) host tensors
+
+    A pass is one call of the backend's merge entry (see `PASS_FUNCTIONS`);
+    within a pass, the layers requested out of order are copied synchronously,
+    and outside of one (eg. lowvram mode, patching on the fly) every layer is
+    """
+
+    _streams: weakref.WeakValueDictionary[int, "PatchStream"] = (
+        weakref.WeakValueDictionary()
+    )
+    _pass: list["PatchStream"] = None
+    _installed: bool = None
+
+    def __init__(self, patches: list[tuple], device: torch.device):
+        self.patches: list[tuple] = list(patches)
+        self.sizes: list[int] = [nbytes(v) for v in self.patches]
+        self.index: dict[int, int] = {id(v): i for i, v in enumerate(self.patches)}
+
+        self.device = torch.device(device)
+        self.window = window()
+
+        cuda = self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(self.device) if cuda else None
+
+        self._pending: dict[int, tuple[tuple, torch.cuda.Event]] = {}
+        self._next: int = 0
+        self._bytes: int = 0
+        self._window_peak: int = 0
+
+        for v in self.patches:
+            PatchStream._streams[id(v)] = self
+
+    @classmethod
+    def fetch(cls, v: tuple) -> tuple:
+        """The patch with its tensors on the device if streamed; otherwise as is"""
+        if (stream := cls._streams.get(id(v))) is None:
+            return v
+
+        i = stream.index[id(v)]
+        if stream.patches[i] is not v:
+            return v
+
+        return stream._take(i)
+
+    def _copy(self, i: int, blocking: bool = False) -> tuple[tuple, torch.cuda.Event]:
+        def to_device(x):
+            if isinstance(x, torch.Tensor):
+                return x.to(self.device, non_blocking=not blocking)
+            if isinstance(x, tuple):
+                return tuple(to_device(y) for y in x)
+            return x
+
+        if self.stream is None or blocking:
+            return to_device(self.patches[i]), None
+
+        with torch.cuda.stream(self.stream):
+            copy = to_device(self.patches[i])
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return copy, event
+
+    def _prefetch(self):
+        inflight = sum(self.sizes[j] for j in self._pending)
+
+        while self._next < len(self.patches):
+            size = self.sizes[self._next]
+            if self._pending and inflight + size > self.window:
+                break
+            self._pending[self._next] = self._copy(self._next)
+            inflight += size
+            self._next += 1
+
+        self._window_peak = max(self._window_peak, inflight)
+
+    def _take(self, i: int) -> tuple:
+        if PatchStream._pass is None:
+            # outside of a merge; eg. patched on the fly in lowvram mode
+            return self._copy(i, blocking=True)[0]
+
+        if self not in PatchStream._pass:
+            PatchStream._pass.append(self)
+            self._begin_pass()
+
+        if i in self._pending:
+            # the layers before it were skipped by the merge
+            for j in [j for j in self._pending if j < i]:
+                del self._pending[j]
+            copy, event = self._pending.pop(i)
+        elif i >= self._next:
+            self._pending.clear()
+            self._next = i
+            self._prefetch()
+            copy, event = self._pending.pop(i)
+        else:
+            # out of order; copied on its own, without disturbing the prefetch
+            copy, event = self._copy(i, blocking=True)
+
+        if event is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            for x in (copy[1] if isinstance(copy[0], str) else copy):
+                if isinstance(x, torch.Tensor):
+                    x.record_stream(current)
+
+        self._bytes += self.sizes[i]
+        self._prefetch()
+        return copy
+
+    def _begin_pass(self):
+        self._pending.clear()
+        self._next = 0
+        self._bytes = 0
+        self._window_peak = 0
+
+    def _end_pass(self):
+        """Releases the copies prefetched for the layers the merge skipped"""
+        self._pending.clear()
+
+    @staticmethod
+    def _substitute(patches: list) -> list:
+        """The patches of a layer, with the streamed ones replaced by their copies"""
+        return [
+            (p[0], PatchStream.fetch(p[1]), *p[2:]) if isinstance(p, tuple) else p
+            for p in patches
+        ]
+
+    @classmethod
+    def install(cls) -> bool:
+        """
+        Wraps the merge functions of the backend, once;
+        returns whether the patches can be streamed
+        """
+        if cls._installed is not None:
+            return cls._installed
+
+        if (merge := _locate(MERGE_FUNCTIONS)) is None:
+            logger.warning("Failed to locate the merge function; not streaming")
+            cls._installed = False
+            return False
+
+        target, name, func = merge
+        setattr(target, name, cls._wrap_merge(func))
+
+        if (entry := _locate(PASS_FUNCTIONS)) is None:
+            logger.warning("Failed to locate the merge entry; copying every layer")
+        else:
+            target, name, func = entry
+            setattr(target, name, cls._wrap_pass(func))
+
+        cls._installed = True
+        return True
+
+    @classmethod
+    def _wrap_merge(cls, func: Callable) -> Callable:
+        @wraps(func)
+        def merge(*args, **kwargs):
+            if cls._streams and args:
+                args = list(args)
+                i = 0 if isinstance(args[0], list) else 1
+                args[i] = cls._substitute(args[i])
+            return func(*args, **kwargs)
+
+        return merge
+
+    @classmethod
+    def _wrap_pass(cls, func: Callable) -> Callable:
+        @wraps(func)
+        def merge_all(*args, **kwargs):
+            if not cls._streams or cls._pass is not None:
+                return func(*args, **kwargs)
+
+            cls._pass = []
+            wall, cpu = time.perf_counter(), time.process_time()
+            vram = {"peak": 0.0}
+            try:
+                with cuda_peak() as vram:
+                    return func(*args, **kwargs)
+            finally:
+                streams, cls._pass = cls._pass, None
+                for stream in streams:
+                    stream._end_pass()
+                if streams:
+                    cls._report(streams, wall, cpu, vram["peak"])
+
+        return merge_all
+
+    @staticmethod
+    def _report(streams: list["PatchStream"], wall: float, cpu: float, peak: float):
+        record = {
+            "wall": time.perf_counter() - wall,
+            "cpu": time.process_time() - cpu,
+            "host_peak": 0.0,
+            "cuda_peak": peak,
+        }
+        Profiler.record("stream patch", record)
+
+        streamed = sum(s._bytes for s in streams) / 1024**2
+        window_peak = max(s._window_peak for s in streams) / 1024**2
+        logger.info(
+            f"Streamed {streamed:.0f} MB of IC-Light weights in {record['wall']:.3f}s "
+            f"(in flight +{window_peak:.0f} MB, peak VRAM +{peak:.0f} MB)"
+        )
@@ -1,8 +1,12 @@
+import hashlib
+
+import cv2
 import numpy as np
 import torch
 from PIL import Image
 
 from modules.images import LANCZOS
+from modules.shared import opts
 
 
 def numpy2pytorch(imgs: np.ndarray) -> torch.Tensor:
@@ -19,19 +23,87 @@ def forge_numpy2pytorch(img: np.ndarray) -> torch.Tensor:
     return h
 
 
+def crop_box(src_w: int, src_h: int, w: int, h: int) -> tuple[float]:
+    """
+    The region of the source that remains visible
+    after resizing it to cover (w, h) then center cropping;
+    rounded as the resized size and the crop offsets were, to whole pixels
+    """
+    scale_factor = max(w / src_w, h / src_h)
+    resized_w = int(round(src_w * scale_factor))
+    resized_h = int(round(src_h * scale_factor))
+    left = int(round((resized_w - w) / 2))
+    top = int(round((resized_h - h) / 2))
+    scale_x, scale_y = src_w / resized_w, src_h / resized_h
+    return (
+        left * scale_x,
+        top * scale_y,
+        (left + w) * scale_x,
+        (top + h) * scale_y,
+    )
+
+
 def resize_and_center_crop(image: np.ndarray, w: int, h: int) -> np.ndarray:
-    pil_image = Image.fromarray(image)
-    original_width, original_height = pil_image.size
-    scale_factor = max(w / original_width, h / original_height)
-    resized_width = int(round(original_width * scale_factor))
-    resized_height = int(round(original_height * scale_factor))
-    resized_image = pil_image.resize((resized_width, resized_height), LANCZOS)
-    left = (resized_width - w) / 2
-    top = (resized_height - h) / 2
-    right = (resized_width + w) / 2
-    bottom = (resized_height + h) / 2
-    cropped_image = resized_image.crop((left, top, right, bottom))
-    return np.asarray(cropped_image, dtype=np.uint8)
+    """
+    Resize the image to cover (w, h) then center crop it;
+    the crop box is computed first so that only the visible region is resampled
+
+    If the size already matches, the input itself is returned, without copying;
+    it may be read-only (eg. a cached Background Removal result, or a shared
+    memory input), so the result must not be modified in place
+    """
+    src_h, src_w = image.shape[:2]
+    if (src_w, src_h) == (w, h):
+        return image
+
+    box = crop_box(src_w, src_h, w, h)
+
+    match getattr(opts, "ic_resize_backend", "PIL"):
+        case "OpenCV":
+            return _resize_cv2(image, box, w, h)
+        case "torch":
+            return _resize_torch(image, box, w, h)
+        case _:
+            return _resize_pil(image, box, w, h)
+
+
+def _resize_pil(image: np.ndarray, box: tuple[float], w: int, h: int) -> np.ndarray:
+    resized_image = Image.fromarray(image).resize((w, h), LANCZOS, box=box)
+    return np.asarray(resized_image, dtype=np.uint8)
+
+
+def _int_box(box: tuple[float]) -> tuple[int]:
+    """Snap the crop box to whole pixels, so that the crop is a view"""
+    left, top, right, bottom = box
+    x0, y0 = int(round(left)), int(round(top))
+    return x0, y0, x0 + int(round(right - left)), y0 + int(round(bottom - top))
+
+
+def _resize_cv2(image: np.ndarray, box: tuple[float], w: int, h: int) -> np.ndarray:
+    x0, y0, x1, y1 = _int_box(box)
+    region = image[y0:y1, x0:x1]
+    downscale = (x1 - x0) > w
+    interpolation = cv2.INTER_AREA if downscale else cv2.INTER_LANCZOS4
+    return cv2.resize(region, (w, h), interpolation=interpolation)
+
+
+@torch.inference_mode()
+def _resize_torch(image: np.ndarray, box: tuple[float], w: int, h: int) -> np.ndarray:
+    x0, y0, x1, y1 = _int_box(box)
+    region = image[y0:y1, x0:x1]
+    if not (region.flags.c_contiguous and region.flags.writeable):
+        # torch.from_numpy warns on read-only buffers
+        region = region.copy()
+    region = torch.from_numpy(region)
+    if region.ndim == 2:
+        region = region[..., None]
+
+    x = region.movedim(-1, 0)[None, ...].float()
+    x = torch.nn.functional.interpolate(
+        x, size=(h, w), mode="bicubic", antialias=True, align_corners=False
+    )
+    x = x[0].movedim(0, -1).round_().clamp_(0, 255).to(torch.uint8)
+    return x.reshape(h, w, *image.shape[2:]).numpy()
 
 
 def align_dim_latent(x: int) -> int:
@@ -51,3 +123,11 @@ def make_masked_area_grey(image: np.ndarray, alpha: np.ndarray) -> np.ndarray:
         .clip(0, 255)
         .astype(np.uint8)
     )
+
+
+def hash_array(image: np.ndarray) -> str:
+    """Content hash of the pixels, including the shape and dtype"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.shape}{image.dtype}".encode())
+    h.update(memoryview(np.ascontiguousarray(image)).cast("B"))
+    return h.hexdigest()
@@ -0,0 +1,112 @@
+from typing import Callable
+
+import torch
+
+from modules.shared import opts
+
+from .logging import logger
+
+TILE_SIZE: int = 512
+TILE_OVERLAP: int = 64
+LATENT_SCALE: int = 8
+
+
+def _ramp(length: int, overlap: int, head: bool, tail: bool) -> torch.Tensor:
+    """1D blending weights that fade in / out over the overlapping edges"""
+    weight = torch.ones(length)
+    fade = torch.linspace(1.0 / (overlap + 1), 1.0, overlap)
+    if head:
+        weight[:overlap] = fade
+    if tail:
+        weight[-overlap:] = fade.flip(0)
+    return weight
+
+
+def _starts(size: int, tile: int, overlap: int) -> list[int]:
+    if size <= tile:
+        return [0]
+
+    stride = tile - overlap
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+    return starts
+
+
+def tiled_encode(
+    encode: Callable[[torch.Tensor], torch.Tensor],
+    pixels: torch.Tensor,
+    tile: int = TILE_SIZE,
+    overlap: int = TILE_OVERLAP,
+) -> torch.Tensor:
+    """
+    Encode the [B, C, H, W] pixels in overlapping tiles,
+    linearly blending the latents where the tiles overlap
+    """
+    _, _, h, w = pixels.shape
+    s = LATENT_SCALE
+    o = overlap // s
+
+    output: torch.Tensor = None
+    weights: torch.Tensor = None
+
+    ys, xs = _starts(h, tile, overlap), _starts(w, tile, overlap)
+
+    for y in ys:
+        for x in xs:
+            latent = encode(pixels[:, :, y : y + tile, x : x + tile])
+
+            if output is None:
+                output = torch.zeros(
+                    (*latent.shape[:2], h // s, w // s),
+                    dtype=torch.float32,
+                    device=latent.device,
+                )
+                weights = torch.zeros((h // s, w // s), device=latent.device)
+
+            lh, lw = latent.shape[2:]
+            weight = (
+                _ramp(lh, o, y > 0, y < ys[-1])[:, None]
+                * _ramp(lw, o, x > 0, x < xs[-1])[None, :]
+            ).to(latent.device)
+
+            ly, lx = y // s, x // s
+            output[:, :, ly : ly + lh, lx : lx + lw] += latent.float() * weight
+            weights[ly : ly + lh, lx : lx + lw] += weight
+
+    return (output / weights).to(latent.dtype)
+
+
+def encode_concat(
+    encode: Callable[[torch.Tensor], torch.Tensor],
+    pixels: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Encode the [B, C, H, W] concat condition,
+    switching to tiled encoding when the pixel count exceeds the threshold
+    """
+    threshold = float(getattr(opts, "ic_tiled_vae", 0.0)) * 1e6
+    b, _, h, w = pixels.shape
+    tiled = threshold > 0 and b * h * w > threshold
+
+    cuda = torch.cuda.is_available()
+    baseline = torch.cuda.memory_allocated() if cuda else 0
+    sampled = [baseline]
+
+    def encode_sampled(x: torch.Tensor) -> torch.Tensor:
+        """Samples the VRAM held after each (tile) encode; the peak stats are untouched"""
+        latent = encode(x)
+        if cuda:
+            sampled.append(torch.cuda.memory_allocated())
+        return latent
+
+    latent = tiled_encode(encode_sampled, pixels) if tiled else encode_sampled(pixels)
+
+    if cuda:
+        held = (max(sampled) - baseline) / 1024**2
+        message = f"Encoded {b}x{w}x{h} concat condition; VRAM +{held:.0f} MB"
+        if tiled:
+            logger.info(f"{message} (tiled)")
+        else:
+            logger.debug(message)
+
+    return latent
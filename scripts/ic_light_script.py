@@ -1,17 +1,25 @@
 import gradio as gr
 import numpy as np
+import torch
 from lib_iclight import VERSION, i2i_fc, raw, removal, t2i_fbc, t2i_fc
+from lib_iclight.api import ic_light_api
 from lib_iclight.backend import BackendType, detect_backend
 from lib_iclight.backgrounds import BackgroundFC
-from lib_iclight.detail_utils import restore_detail
+from lib_iclight.detail_utils import restore_detail_batch
+from lib_iclight.image_source import export_images
+from lib_iclight.incremental import Stages
 from lib_iclight.logging import logger
+from lib_iclight.matting import MATTING
 from lib_iclight.model_loader import ICModels
 from lib_iclight.parameters import ICLightArgs
-from lib_iclight.rembg_utils import get_models
+from lib_iclight.profiler import Profiler
+from lib_iclight.rembg_utils import RembgPrefetch, SessionPool, get_models
 from lib_iclight.settings import ic_settings
 
 from modules import scripts
-from modules.script_callbacks import on_ui_settings
+from modules.devices import device
+from modules.processing import StableDiffusionProcessingImg2Img
+from modules.script_callbacks import on_app_started, on_model_loaded, on_ui_settings
 from modules.shared import opts
 from modules.ui_components import InputAccordion
 
@@ -20,7 +28,7 @@ backend_type = detect_backend()
 if backend_type is BackendType.A1111:
     from lib_iclight.backends.a1111 import apply_ic_light
 else:
-    from lib_iclight.backends.forge import apply_ic_light
+    from lib_iclight.backends.forge import PatchedUnetCache, apply_ic_light
 
     if backend_type == BackendType.reForge:
         from lib_iclight import patch_weight  # noqa
@@ -43,9 +51,9 @@ class ICLightScript(scripts.Script):
             with gr.Row():
                 model_type = gr.Dropdown(
                     label="Mode",
-                    choices=[ICModels.fc, ICModels.fbc],
+                    choices=ICModels.choices("fc" if is_img2img else None),
                     value=ICModels.fc,
-                    interactive=(not is_img2img),
+                    interactive=(not is_img2img or len(ICModels.choices("fc")) > 1),
                 )
                 desc = gr.Markdown(
                     value=(i2i_fc if is_img2img else t2i_fc),
@@ -135,6 +143,21 @@ class ICLightScript(scripts.Script):
                     maximum=128,
                     step=1,
                 )
+                with gr.Row():
+                    matting = gr.Dropdown(
+                        label="Matting",
+                        info="guided filter = much faster on large images",
+                        choices=list(MATTING),
+                        value=MATTING[0],
+                    )
+                    rembg_max_size = gr.Slider(
+                        label="Segmentation Resolution",
+                        info="caps the longest side; 0 = original",
+                        value=0,
+                        minimum=0,
+                        maximum=2048,
+                        step=64,
+                    )
 
             with InputAccordion(False, label="Restore Details") as detail_transfer:
                 detail_transfer_raw = gr.Checkbox(False, label=raw)
@@ -154,10 +177,32 @@ class ICLightScript(scripts.Script):
                     info="Paste the Subject onto the Lighting Conditioning",
                 )
 
+        # for the API; where to write the outputs, see export_images
+        output_target = gr.JSON(value=None, visible=False)
+
         if is_img2img:
-            self._hook_i2i(input_fg, background_source)
+            self._hook_i2i(
+                input_fg,
+                background_source,
+                getattr(self, "img2img_width", None),
+                getattr(self, "img2img_height", None),
+            )
         else:
             self._hook_t2i(model_type, flip_bg, uploaded_bg, desc)
+            input_fg.upload(
+                fn=self._prefetch_rmbg,
+                inputs=[
+                    input_fg,
+                    remove_bg,
+                    rembg_model,
+                    foreground_threshold,
+                    background_threshold,
+                    erode_size,
+                    matting,
+                    rembg_max_size,
+                ],
+                show_progress="hidden",
+            )
 
         components: list[gr.components.Component] = [
             enable,
@@ -173,6 +218,9 @@ class ICLightScript(scripts.Script):
             detail_transfer_raw,
             detail_transfer_blur_radius,
             reinforce_fg,
+            output_target,
+            matting,
+            rembg_max_size,
         ]
 
         for comp in components:
@@ -193,38 +241,97 @@ class ICLightScript(scripts.Script):
             logger.error("An input image is required...")
             return
 
-        self.args = ICLightArgs(p, *args)
-        self.extra_images.append(self.args.input_fg_rgb)
+        if isinstance(args[1], (list, tuple)):
+            if isinstance(p, StableDiffusionProcessingImg2Img):
+                logger.error("Batched foregrounds are only supported in txt2img...")
+                return
+            if p.batch_size != len(args[1]):
+                logger.info(f"Setting Batch Size to {len(args[1])} to match the inputs")
+                p.batch_size = len(args[1])
+
+        Profiler.begin_job()
+        Stages.begin_job()
+        with Profiler.stage("preprocess"):
+            self.args = ICLightArgs(p, *args)
+
+        self.extra_images.extend(self.args.input_fgs_rgb)
 
     def process_before_every_sampling(self, p, *args, **kwargs):
         if self.args is not None:
             apply_ic_light(p, self.args)
 
+    @staticmethod
+    def _prefetch_rmbg(image: np.ndarray | None, remove_bg: bool, *params):
+        """Start removing the background as soon as the Foreground is uploaded"""
+        if remove_bg:
+            RembgPrefetch.submit(image, *params)
+
+    @staticmethod
+    def _restore_on_device() -> bool:
+        """Restore details on the decoded tensors; requires an accelerator"""
+        return getattr(opts, "ic_detail_gpu", False) and device.type != "cpu"
+
+    def postprocess_batch(self, p, *args, **kwargs):
+        if self.args is None:
+            return
+        if not self.args.detail_transfer.enable:
+            return
+        if not self._restore_on_device():
+            return
+
+        images = kwargs["images"]
+        restorers = [
+            self.args.detail_transfer.get_restorer(i) for i in range(len(images))
+        ]
+
+        with Profiler.stage("restore detail"):
+            self.extra_images.extend(
+                restore_detail_batch(torch.stack(list(images)), restorers, device)
+            )
+
     def postprocess_image(self, p, pp, *args, **kwargs):
         if self.args is None:
             return
         if not self.args.detail_transfer.enable:
             return
+        if self._restore_on_device():
+            return
+
+        restorer = self.args.detail_transfer.get_restorer(getattr(p, "batch_index", 0))
 
-        self.extra_images.append(
-            restore_detail(
-                np.asarray(pp.image, dtype=np.uint8),
-                self.args.detail_transfer.original,
-                self.args.detail_transfer.radius,
+        with Profiler.stage("restore detail"):
+            self.extra_images.append(
+                restorer.restore(np.asarray(pp.image, dtype=np.uint8))
             )
-        )
 
     def postprocess(self, p, processed, *args, **kwargs):
         if self.args is None:
             return
 
         processed.images.extend(self.extra_images)
+        self.extra_images = []
+
+        if (target := self.args.output_target) is not None:
+            try:
+                outputs = export_images(processed.images, target)
+                processed.extra_generation_params["IC-Light Outputs"] = outputs
+            except Exception as e:
+                logger.error(f"Failed to export the outputs: {e}")
+
+        self.args.release()
+        Stages.end_job()
+        Profiler.end_job()
 
     def after_component(self, component: gr.Slider, **kwargs):
-        if not getattr(opts, "ic_sync_dim", True):
+        if not (elem_id := kwargs.get("elem_id", None)):
             return
 
-        if not (elem_id := kwargs.get("elem_id", None)):
+        if elem_id == "img2img_width":
+            self.img2img_width = component
+        if elem_id == "img2img_height":
+            self.img2img_height = component
+
+        if not getattr(opts, "ic_sync_dim", True):
             return
 
         if elem_id == "txt2img_width":
@@ -235,14 +342,14 @@ class ICLightScript(scripts.Script):
     @staticmethod
     def _hook_t2i(model_type: gr.Dropdown, flip_bg: gr.Button, uploaded_bg, desc):
         def on_model_change(model: str):
-            match model:
-                case ICModels.fc:
+            match ICModels.get_kind(model):
+                case "fc":
                     return (
                         gr.update(visible=False),
                         gr.update(visible=False),
                         gr.update(value=t2i_fc),
                     )
-                case ICModels.fbc:
+                case "fbc":
                     return (
                         gr.update(visible=True),
                         gr.update(visible=True),
@@ -266,17 +373,25 @@ class ICLightScript(scripts.Script):
         flip_bg.click(fn=on_flip_image, inputs=[uploaded_bg], outputs=[uploaded_bg])
 
     @staticmethod
-    def _hook_i2i(input_fg: gr.Image, background_source: gr.Dropdown):
-        def update_img2img_input(source: str):
+    def _hook_i2i(
+        input_fg: gr.Image,
+        background_source: gr.Dropdown,
+        width: gr.Slider | None,
+        height: gr.Slider | None,
+    ):
+        """Generate the light map at the img2img resolution if available"""
+        dimensions = [] if (width is None or height is None) else [width, height]
+
+        def update_img2img_input(source: str, w: int = 512, h: int = 512):
             source_fc = BackgroundFC(source)
             if source_fc is BackgroundFC.CUSTOM:
                 return gr.skip()
             else:
-                return gr.update(value=source_fc.get_bg())
+                return gr.update(value=source_fc.get_bg(w, h))
 
         background_source.input(
             fn=update_img2img_input,
-            inputs=[background_source],
+            inputs=[background_source, *dimensions],
             outputs=[input_fg],
             show_progress="hidden",
         )
@@ -289,3 +404,11 @@ class ICLightScript(scripts.Script):
 
 
 on_ui_settings(ic_settings)
+on_app_started(ic_light_api)
+
+if backend_type is not BackendType.A1111:
+    # the patched UNets of the previous checkpoint would stay resident
+    on_model_loaded(lambda _: PatchedUnetCache.clear())
+
+if getattr(opts, "ic_rembg_warmup", False):
+    SessionPool.warmup(get_models())